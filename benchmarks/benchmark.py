@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for pikvm-ha-sensors.
+
+Runs the application against local stand-ins (see fakes.py) for the 1-wire
+and I2C sensors, the node_exporter and kvmd endpoints and the MQTT broker,
+and reports how the update cycle scales with the number of sensors:
+
+  uv run --group dev benchmarks/benchmark.py --sensors 10 100 1000
+
+Each sensor count is measured in a fresh interpreter, so that peak RSS and
+the state held by the application and its drivers don't carry over.
+"""
+import os, sys, json, time, yaml, argparse, tempfile, resource, subprocess, importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# Sensors making up each block of ten in the generated sensors.yaml
+SENSOR_MIX = (
+  ('ds18b20',  'temperature'),
+  ('ds18b20',  'temperature'),
+  ('htu21d',   'temperature'),
+  ('htu21d',   'relative_humidity'),
+  ('hostinfo', 'host_cpu_temperature'),
+  ('hostinfo', 'cpu_fan_speed'),
+  ('hostinfo', 'pump_speed'),
+  ('kvmd',     'atx_power'),
+  ('sysinfo',  'uptime'),
+  ('sysinfo',  'loadavg_1min')
+)
+
+
+def percentile(values, fraction):
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def generate_sensors(count):
+  sensors = []
+  for index in range(count):
+    device_type, device_property = SENSOR_MIX[index % len(SENSOR_MIX)]
+    block = index // len(SENSOR_MIX)
+    sensor = {
+      'name':               "{}_{}_{}".format(device_type, device_property, index),
+      'device_type':        device_type,
+      'device_property':    device_property,
+      'output_precision':   2,
+      'ha_component_type':  'sensor',
+      'ha_title':           "Benchmark {}".format(index)
+    }
+    match device_type:
+      case 'ds18b20':
+        sensor['device_address'] = "{:012x}".format(index)
+      case 'htu21d':
+        sensor['device_address'] = 0x40 + block % 0x40
+    sensors.append(sensor)
+  return sensors
+
+
+def run(count, cycles, conversion_delay, bulk_read, overrides):
+  """Measure one sensor count in this process; returns a dict of results."""
+  sys.path.insert(0, ROOT)
+  sys.path.insert(0, HERE)
+  os.environ['W1THERMSENSOR_NO_KERNEL_MODULE'] = '1'
+  import fakes
+
+  sensors = generate_sensors(count)
+  workdir = tempfile.mkdtemp(prefix='pikvm-ha-bench-')
+  probes = [sensor['device_address'] for sensor in sensors if sensor['device_type'] == 'ds18b20']
+  w1_bus = fakes.FakeW1Bus(workdir, probes, conversion_delay=conversion_delay, bulk_read=bulk_read)
+  from w1thermsensor import W1ThermSensor
+  from pathlib import Path
+  W1ThermSensor.BASE_DIRECTORY = Path(w1_bus.devices_dir)
+  fakes.FakeHTU21DBus.install(fakes.FakeHTU21DBus())
+  prometheus_url = fakes.serve_http({'/metrics': fakes.node_exporter_metrics()}) + "/metrics"
+  kvmd_socket = fakes.serve_unix_http(fakes.kvmd_api_routes(prefix=''), os.path.join(workdir, 'kvmd.sock'))
+  broker = fakes.FakeMQTTBroker()
+
+  # Stand in for the PiKVM's network interface on machines without an eth0
+  import netifaces
+  if 'eth0' not in netifaces.interfaces():
+    netifaces.ifaddresses = lambda interface: {
+      netifaces.AF_INET:  [{'addr': '127.0.0.1'}],
+      netifaces.AF_INET6: [{'addr': '::1'}]
+    }
+
+  started = time.perf_counter()
+  spec = importlib.util.spec_from_file_location('pikvm_ha_sensors', os.path.join(ROOT, 'pikvm-ha-sensors.py'))
+  app = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(app)
+  config = {
+    'mqtt_broker':    '127.0.0.1',
+    'mqtt_port':      broker.port,
+    'prometheus_url': prometheus_url,
+    'kvmd_events':    False,
+    'kvmd_socket':    kvmd_socket,
+    'identity_cache': os.path.join(workdir, 'identity.json'),
+    'outbox_journal': os.path.join(workdir, 'outbox.jsonl'),
+    'discovery_cache': os.path.join(workdir, 'discovery.json'),
+    'outbox_persistent_copy': None
+  } | overrides
+  pikvmha = app.PiKVMHASensors(config, sensors)
+  for sensor in pikvmha.sensors:
+    pikvmha.init_sensor(sensor)
+  pikvmha.mqtt_connect()
+  while not pikvmha.mqtt_connected:
+    time.sleep(0.01)
+  startup = time.perf_counter() - started
+
+  def drain():
+    # Publishing is asynchronous: wait for the broker to stop receiving
+    counters = broker.counters()
+    while True:
+      time.sleep(0.2)
+      latest = broker.counters()
+      if latest == counters:
+        return latest
+      counters = latest
+
+  pikvmha.update()  # warm up (and let the discovery messages through)
+  messages, size = drain()
+  durations = []
+  cpu = time.process_time()
+  for _ in range(cycles):
+    cycle = time.perf_counter()
+    pikvmha.update()
+    durations.append(time.perf_counter() - cycle)
+  cpu = time.process_time() - cpu
+  total_messages, total_bytes = drain()
+  return {
+    'sensors':          count,
+    'cycles':           cycles,
+    'startup_s':        startup,
+    'cycle_p50_s':      percentile(durations, 0.50),
+    'cycle_p90_s':      percentile(durations, 0.90),
+    'cycle_p99_s':      percentile(durations, 0.99),
+    'cycle_max_s':      max(durations),
+    'messages_per_cycle': (total_messages - messages) / cycles,
+    'bytes_per_cycle':  (total_bytes - size) / cycles,
+    'cpu_per_cycle_s':  cpu / cycles,
+    'peak_rss_mb':      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  }
+
+
+def main(args):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--sensors', type=int, nargs='+', default=[10, 100, 1000], help="sensor counts to measure")
+  parser.add_argument('--cycles', type=int, default=20, help="update cycles to measure per sensor count")
+  parser.add_argument('--conversion-delay', type=float, default=0.75, help="DS18B20 conversion time, in seconds")
+  parser.add_argument('--no-bulk-read', dest='bulk_read', action='store_false', help="leave therm_bulk_read out of the w1 tree")
+  parser.add_argument('--config', metavar='KEY=VALUE', action='append', default=[], help="override a config.yaml setting (repeatable)")
+  parser.add_argument('--json', action='store_true', help="print the results as JSON, for comparing releases")
+  parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+  options = parser.parse_args(args)
+  overrides = {}
+  for setting in options.config:
+    key, _, value = setting.partition('=')
+    overrides[key] = yaml.safe_load(value)
+
+  if options.child is not None:
+    print(json.dumps(run(options.child, options.cycles, options.conversion_delay, options.bulk_read, overrides)))
+    return
+
+  results = []
+  for count in options.sensors:
+    child = [sys.executable, os.path.abspath(__file__), '--child', str(count), '--cycles', str(options.cycles),
+             '--conversion-delay', str(options.conversion_delay)] + ([] if options.bulk_read else ['--no-bulk-read']) \
+            + [argument for setting in options.config for argument in ('--config', setting)]
+    output = subprocess.run(child, check=True, capture_output=True, text=True).stdout
+    results.append(json.loads(output.strip().splitlines()[-1]))
+
+  if options.json:
+    print(json.dumps(results, indent=2))
+    return
+  print("{:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10} {:>11} {:>10} {:>9}".format(
+    'sensors', 'startup', 'p50', 'p90', 'p99', 'max', 'msgs/cyc', 'bytes/cyc', 'cpu/cyc', 'rss'))
+  for r in results:
+    print("{:>8} {:>8.2f}s {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms {:>10.1f} {:>11.0f} {:>8.1f}ms {:>7.1f}MB".format(
+      r['sensors'], r['startup_s'], r['cycle_p50_s'] * 1000, r['cycle_p90_s'] * 1000, r['cycle_p99_s'] * 1000,
+      r['cycle_max_s'] * 1000, r['messages_per_cycle'], r['bytes_per_cycle'], r['cpu_per_cycle_s'] * 1000, r['peak_rss_mb']))
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
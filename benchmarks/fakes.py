@@ -0,0 +1,284 @@
+"""
+Local stand-ins for the hardware, services and broker used by pikvm-ha-sensors,
+so that the application can be benchmarked on any Linux machine.
+"""
+import os, sys, json, time, types, struct, threading, socketserver, http.server
+
+
+class FakeW1Bus:
+  """
+  A w1 sysfs tree for one bus master with DS18B20 probes. The probes' data
+  files are FIFOs served by threads, so that reading one blocks for the
+  configured conversion delay, as the w1_therm driver does. Triggering a bulk
+  conversion (therm_bulk_read) starts one conversion for every probe, whose
+  results can then each be read once without a further delay.
+  """
+
+  def __init__(self, root, probe_ids, conversion_delay=0.75, bulk_read=True):
+    self.conversion_delay = conversion_delay
+    self.master_dir = os.path.join(root, 'devices', 'w1_bus_master1')
+    self.devices_dir = os.path.join(root, 'bus', 'w1', 'devices')
+    os.makedirs(self.master_dir)
+    os.makedirs(self.devices_dir)
+    self.pending = {}
+    self.lock = threading.Lock()
+    self.bulk_read_path = os.path.join(self.master_dir, 'therm_bulk_read')
+    if bulk_read:
+      open(self.bulk_read_path, 'w').close()
+    for index, probe_id in enumerate(probe_ids):
+      slave_dir = os.path.join(self.master_dir, '28-{}'.format(probe_id))
+      os.makedirs(slave_dir)
+      os.symlink(slave_dir, os.path.join(self.devices_dir, '28-{}'.format(probe_id)))
+      with open(os.path.join(slave_dir, 'resolution'), 'w') as f:
+        f.write("12\n")
+      millidegrees = 18000 + 125 * index
+      for name, content in (
+        ('temperature', "{}\n".format(millidegrees)),
+        ('w1_slave', "a0 01 4b 46 7f ff 0c 10 5c : crc=5c YES\na0 01 4b 46 7f ff 0c 10 5c t={}\n".format(millidegrees))
+      ):
+        path = os.path.join(slave_dir, name)
+        os.mkfifo(path)
+        self._serve(self._conversion, path, probe_id, content)
+
+  def _serve(self, target, *args):
+    threading.Thread(target=target, args=args, daemon=True).start()
+
+  def _bulk_conversion_ready(self, probe_id):
+    # A trigger written to therm_bulk_read (a plain file here) starts a
+    # conversion on every probe at the time it was written
+    with self.lock:
+      if os.path.exists(self.bulk_read_path) and os.path.getsize(self.bulk_read_path):
+        ready = os.path.getmtime(self.bulk_read_path) + self.conversion_delay
+        self.pending = {probe: ready for probe in os.listdir(self.devices_dir)}
+        open(self.bulk_read_path, 'w').close()
+      return self.pending.pop('28-{}'.format(probe_id), None)
+
+  def _conversion(self, path, probe_id, content):
+    while True:
+      # Blocks until the driver opens the file for reading
+      with open(path, 'w') as f:
+        ready = self._bulk_conversion_ready(probe_id)
+        delay = self.conversion_delay if ready is None else ready - time.time()
+        if delay > 0:
+          time.sleep(delay)
+        f.write(content)
+      # Give the reader time to see the end of the file and close it, as
+      # reopening straight away would hand it the content a second time
+      time.sleep(0.01)
+
+
+class FakeHTU21DBus:
+  """An I2C bus (busio.I2C) with HTU21D chips answering at every address."""
+
+  def __init__(self, temperature=22.5, humidity=45.0):
+    self.temperature = temperature
+    self.humidity = humidity
+    self.registers = {}
+    self.commands = {}
+    self.transactions = 0
+    self.lock = threading.Lock()
+
+  def try_lock(self):
+    return self.lock.acquire(blocking=False)
+
+  def unlock(self):
+    self.lock.release()
+
+  def _measurement(self, address):
+    # Raw values use the conversion formulae from the datasheet, with a CRC
+    import adafruit_htu21d
+    if self.commands.get(address) == 0xF3:
+      raw = int((self.temperature + 46.85) * 65536 / 175.72) & 0xFFFC
+    else:
+      raw = int((self.humidity + 6.0) * 65536 / 125.0) & 0xFFFC | 0x02
+    data = bytearray(struct.pack(">H", raw))
+    return data + bytes([adafruit_htu21d._crc(data)])
+
+  def writeto(self, address, buffer, *, start=0, end=None):
+    self.transactions += 1
+    data = bytes(buffer[start:end])
+    if data[:1] == b'\xE6':
+      self.registers[address] = data[1]
+    elif data:
+      self.commands[address] = data[0]
+
+  def readfrom_into(self, address, buffer, *, start=0, end=None):
+    self.transactions += 1
+    data = self._measurement(address)
+    end = len(buffer) if end is None else end
+    buffer[start:end] = data[:end - start]
+
+  def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None, in_start=0, in_end=None):
+    self.transactions += 1
+    command = buffer_out[out_start]
+    if command == 0xE7:
+      buffer_in[in_start] = self.registers.get(address, 0x02)
+    elif command == 0xFA:
+      buffer_in[in_start:in_start + 8] = bytes([0x00, 0x00, 0x12, 0x00, 0x34, 0x00, 0x56, 0x00])
+    elif command == 0xFC:
+      buffer_in[in_start:in_start + 6] = bytes([0x32, address, 0x00, 0x48, 0x54, 0x00])
+
+  @staticmethod
+  def install(i2c_bus):
+    """Make 'board' and 'busio' (Blinka) hand out this bus, before htu21d is imported."""
+    board = types.ModuleType('board')
+    board.SCL = board.SDA = None
+    busio = types.ModuleType('busio')
+    busio.I2C = lambda scl, sda: i2c_bus
+    sys.modules['board'] = board
+    sys.modules['busio'] = busio
+
+
+def node_exporter_metrics(cpus=4, filler_families=150):
+  """A node_exporter page of a realistic size, with the hwmon metrics hostinfo reads."""
+  lines = [
+    '# HELP node_dmi_info A metric with a constant \'1\' value labeled by bios_date, bios_release, bios_vendor, bios_version, board_asset_tag, board_name, board_serial, board_vendor, board_version, chassis_asset_tag, chassis_serial, chassis_vendor, chassis_version, product_family, product_name, product_serial, product_sku, product_uuid, product_version, system_vendor if provided by DMI.',
+    '# TYPE node_dmi_info gauge',
+    'node_dmi_info{bios_vendor="American Megatrends Inc.",board_name="B450 I AORUS PRO WIFI-CF",board_vendor="Gigabyte Technology Co., Ltd.",system_vendor="Gigabyte Technology Co., Ltd."} 1',
+    '# HELP node_hwmon_fan_rpm Hardware monitor for fan revolutions per minute (input)',
+    '# TYPE node_hwmon_fan_rpm gauge'
+  ]
+  lines += ['node_hwmon_fan_rpm{{chip="platform_nct6683_2592",sensor="fan{}"}} {}'.format(fan, 600 + 100 * fan) for fan in range(1, 9)]
+  lines += [
+    '# HELP node_hwmon_temp_celsius Hardware monitor for temperature (input)',
+    '# TYPE node_hwmon_temp_celsius gauge',
+    'node_hwmon_temp_celsius{chip="pci0000:00_0000:00:18_3",sensor="temp1"} 34.125'
+  ]
+  lines += ['node_hwmon_temp_celsius{{chip="platform_nct6683_2592",sensor="temp{}"}} {}'.format(sensor, 30 + sensor) for sensor in range(1, 9)]
+  for family in range(filler_families):
+    lines += [
+      '# HELP node_filler_{}_total Stand-in for the metrics hostinfo does not use.'.format(family),
+      '# TYPE node_filler_{}_total counter'.format(family)
+    ]
+    lines += ['node_filler_{}_total{{cpu="{}",mode="user"}} {}'.format(family, cpu, 12345.67 * cpu) for cpu in range(cpus * 4)]
+  return ("\n".join(lines) + "\n").encode()
+
+
+class _QuietHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  routes = {}
+
+  def do_GET(self):
+    body = self.routes.get(self.path.split('?')[0])
+    if body is None:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json' if body[:1] == b'{' else 'text/plain; version=0.0.4; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def serve_http(routes):
+  """Serve canned responses on a local port; returns the base URL."""
+  handler = type('Handler', (_QuietHandler,), {'routes': routes})
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return "http://127.0.0.1:{}".format(server.server_port)
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+  daemon_threads = True
+
+  def get_request(self):
+    # BaseHTTPRequestHandler expects a (host, port) client address
+    request, _ = super().get_request()
+    return request, ('local', 0)
+
+
+def serve_unix_http(routes, path):
+  """Serve canned responses on a unix socket, as kvmd does; returns the socket path."""
+  handler = type('Handler', (_QuietHandler,), {'routes': routes})
+  server = _UnixHTTPServer(path, handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return path
+
+
+def kvmd_api_routes(prefix='/api'):
+  """
+  Canned responses for the kvmd API endpoints used by the kvmd sensor type.
+  kvmd serves them without the prefix on its own socket, and nginx adds it.
+  """
+  def result(data):
+    return json.dumps({'ok': True, 'result': data}).encode()
+  return {
+    prefix + '/atx':      result({'enabled': True, 'busy': False, 'leds': {'power': True, 'hdd': False}}),
+    prefix + '/hid':      result({'online': True, 'busy': False, 'connected': None}),
+    prefix + '/msd':      result({'enabled': True, 'online': True, 'busy': False, 'drive': {'connected': False, 'image': None}}),
+    prefix + '/streamer': result({'streamer': {'source': {'online': True, 'captured_fps': 30}, 'stream': {'clients': 1, 'queued_fps': 30}}})
+  }
+
+
+class FakeMQTTBroker(socketserver.ThreadingTCPServer):
+  """
+  Just enough of an MQTT 3.1.1 broker to accept a client's connection and
+  publications. Messages are not routed anywhere, only counted.
+  """
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self):
+    super().__init__(('127.0.0.1', 0), _MQTTHandler)
+    self.messages = 0
+    self.bytes = 0
+    self.lock = threading.Lock()
+    threading.Thread(target=self.serve_forever, daemon=True).start()
+
+  @property
+  def port(self):
+    return self.server_address[1]
+
+  def counters(self):
+    with self.lock:
+      return self.messages, self.bytes
+
+
+class _MQTTHandler(socketserver.StreamRequestHandler):
+
+  def read_packet(self):
+    header = self.rfile.read(1)
+    if not header:
+      return None, None, 0
+    length, multiplier, size = 0, 1, 1
+    while True:
+      byte = self.rfile.read(1)[0]
+      size += 1
+      length += (byte & 0x7F) * multiplier
+      multiplier *= 128
+      if not byte & 0x80:
+        break
+    return header[0], self.rfile.read(length), size + length
+
+  def handle(self):
+    while True:
+      header, body, size = self.read_packet()
+      if header is None:
+        return
+      match header >> 4:
+        case 1:   # CONNECT
+          self.wfile.write(b'\x20\x02\x00\x00')
+        case 3:   # PUBLISH
+          with self.server.lock:
+            self.server.messages += 1
+            self.server.bytes += size
+          if (header >> 1) & 0x03:
+            topic_length = struct.unpack(">H", body[:2])[0]
+            packet_id = body[2 + topic_length:4 + topic_length]
+            self.wfile.write((b'\x40\x02' if (header >> 1) & 0x03 == 1 else b'\x50\x02') + packet_id)
+        case 6:   # PUBREL
+          self.wfile.write(b'\x70\x02' + body[:2])
+        case 8:   # SUBSCRIBE
+          topics, offset = 0, 2
+          while offset < len(body):
+            offset += 2 + struct.unpack(">H", body[offset:offset + 2])[0] + 1
+            topics += 1
+          self.wfile.write(bytes([0x90, 2 + topics]) + body[:2] + b'\x00' * topics)
+        case 12:  # PINGREQ
+          self.wfile.write(b'\xd0\x00')
+        case 14:  # DISCONNECT
+          return
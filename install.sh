@@ -16,6 +16,7 @@ git archive HEAD | tar -x -C $INSTALL_DIR \
   --exclude='install.sh' \
   --exclude='*.md' \
   --exclude='.vscode' \
+  --exclude='benchmarks' \
 
 uv sync
 
@@ -0,0 +1,89 @@
+import time, threading, bisect
+from contextlib import contextmanager
+
+
+class Histogram:
+  """
+  Durations counted into fixed buckets, so that recording one costs the
+  same however long the service has been running. Percentiles are given as
+  the upper bound of the bucket they fall in (or the largest duration seen,
+  if that is lower).
+  """
+  __slots__ = ('counts', 'count', 'total', 'max')
+
+  # Bucket upper bounds, in milliseconds; the last bucket is open-ended
+  bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+  def __init__(self):
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def observe(self, milliseconds):
+    self.counts[bisect.bisect_left(self.bounds, milliseconds)] += 1
+    self.count += 1
+    self.total += milliseconds
+    self.max = max(self.max, milliseconds)
+
+  def percentile(self, q):
+    if self.count == 0:
+      return None
+    rank = q * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank:
+        return min(self.bounds[i], round(self.max, 3)) if i < len(self.bounds) else round(self.max, 3)
+    return round(self.max, 3)
+
+  def as_dict(self):
+    return {
+      'count':    self.count,
+      'mean_ms':  round(self.total / self.count, 3) if self.count else None,
+      'p50_ms':   self.percentile(0.5),
+      'p90_ms':   self.percentile(0.9),
+      'p99_ms':   self.percentile(0.99),
+      'max_ms':   round(self.max, 3)
+    }
+
+
+class Diagnostics:
+  """Named latency histograms and counters, safe to update from any thread."""
+
+  def __init__(self):
+    self.timers = {}
+    self.counters = {}
+    self.lock = threading.Lock()
+
+  def observe(self, name, seconds):
+    with self.lock:
+      if name not in self.timers:
+        self.timers[name] = Histogram()
+      self.timers[name].observe(seconds * 1000)
+
+  def count(self, name, increment=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + increment
+
+  def discard(self, names):
+    """Forget the timers and counters with these names, e.g. those of a removed sensor."""
+    with self.lock:
+      for name in names:
+        self.timers.pop(name, None)
+        self.counters.pop(name, None)
+
+  @contextmanager
+  def timer(self, name):
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - started)
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        'timers':   { name: histogram.as_dict() for name, histogram in self.timers.items() },
+        'counters': dict(self.counters)
+      }
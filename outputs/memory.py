@@ -0,0 +1,72 @@
+import os, gc, ctypes, ctypes.util, tracemalloc
+
+MIB = 1048576
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+_libc = None
+
+
+def rss_bytes():
+  """The resident set size of this process, or None if it can't be read."""
+  try:
+    with open('/proc/self/statm', 'rb') as f:
+      return int(f.read().split()[1]) * PAGE_SIZE
+  except (OSError, ValueError, IndexError):
+    return None
+
+
+def heap_bytes():
+  """The memory currently allocated by Python, if tracemalloc is tracing."""
+  return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+
+def trim():
+  """Collect garbage, then hand the heap memory freed back to the system (on glibc)."""
+  global _libc
+  gc.collect()
+  if _libc is None:
+    try:
+      _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+      _libc.malloc_trim.argtypes = [ctypes.c_size_t]
+    except (OSError, AttributeError):
+      _libc = False
+  if _libc:
+    _libc.malloc_trim(0)
+
+
+class MemoryTracer:
+  """
+  Reports which lines of code the memory allocated since the previous report
+  came from, using tracemalloc. Tracing slows allocation down, so it only
+  starts with the first report unless it was started with the service.
+  """
+
+  # Allocations made by tracemalloc itself and the import machinery are noise
+  ignored = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>")
+
+  def __init__(self, top: int = 10):
+    self.top = top
+    self.baseline = None
+
+  def start(self):
+    if not tracemalloc.is_tracing():
+      tracemalloc.start()
+    self.baseline = self.snapshot()
+
+  def snapshot(self):
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, pattern) for pattern in self.ignored])
+
+  def report(self):
+    """Lines describing the largest changes since the last report, or None if tracing has only just started."""
+    if self.baseline is None or not tracemalloc.is_tracing():
+      self.start()
+      return None
+    snapshot = self.snapshot()
+    changes = snapshot.compare_to(self.baseline, 'lineno')
+    self.baseline = snapshot
+    lines = []
+    for change in changes[:self.top]:
+      frame = change.traceback[0]
+      lines.append("{:+.1f} KiB ({:+d} blocks), {:.1f} KiB in all: {}:{}".format(
+        change.size_diff / 1024, change.count_diff, change.size / 1024, frame.filename, frame.lineno))
+    return lines
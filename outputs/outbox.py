@@ -0,0 +1,110 @@
+import os, json, shutil, threading, subprocess, collections, itertools
+
+
+class Outbox:
+  """
+  A bounded store-and-forward queue for MQTT messages that could not be
+  published while the broker was unreachable.
+
+  Messages are appended, one compact JSON line each, to a journal on tmpfs,
+  which survives restarts of the service. PiKVM only mounts its persistent
+  storage partition read-write on demand, so instead of writing there on
+  every append, the journal is copied there from time to time through
+  kvmd-pstrun (see persist()), so the queue also survives a reboot. When the
+  journal grows past max_bytes, the oldest messages are dropped.
+  """
+
+  def __init__(self, journal: str, persistent_copy: str = None, max_bytes: int = 1048576):
+    self.journal = journal
+    self.persistent_copy = persistent_copy
+    self.max_bytes = max_bytes
+    self.messages = collections.deque()
+    self.size = 0
+    self.dirty = False
+    self.lock = threading.Lock()
+    self.persist_lock = threading.Lock()
+    if os.path.dirname(journal):
+      os.makedirs(os.path.dirname(journal), exist_ok=True)
+    self.load()
+
+  def __len__(self):
+    return len(self.messages)
+
+  def load(self):
+    # The journal on tmpfs is the most recent; after a reboot only the
+    # persistent copy is left
+    for path in (self.journal, self.persistent_copy):
+      if path is not None and os.path.exists(path):
+        with open(path, 'r') as f:
+          for line in f:
+            try:
+              self.messages.append((json.loads(line), len(line.encode())))
+            except ValueError:
+              pass  # a write torn by a crash
+        break
+    self.size = sum(size for _, size in self.messages)
+    self.trim()
+    self.rewrite()
+
+  def append(self, topic, payload, qos, retain):
+    line = json.dumps([topic, payload, qos, retain], separators=(',', ':')) + "\n"
+    with self.lock:
+      self.messages.append(([topic, payload, qos, retain], len(line.encode())))
+      self.size += len(line.encode())
+      self.dirty = True
+      if self.trim():
+        self.rewrite()
+      else:
+        with open(self.journal, 'a') as f:
+          f.write(line)
+
+  def peek(self, count):
+    """The oldest count messages, as [topic, payload, qos, retain] lists."""
+    with self.lock:
+      return [message for message, _ in itertools.islice(self.messages, count)]
+
+  def remove(self, count):
+    """Drop the oldest count messages, once they have been delivered."""
+    with self.lock:
+      for _ in range(min(count, len(self.messages))):
+        self.size -= self.messages.popleft()[1]
+      self.dirty = True
+      self.rewrite()
+
+  def trim(self):
+    # Drop the oldest messages down to three quarters of the limit, so that
+    # the journal isn't rewritten on every append once it is full
+    if self.size <= self.max_bytes:
+      return False
+    while self.messages and self.size > self.max_bytes * 3 // 4:
+      self.size -= self.messages.popleft()[1]
+    return True
+
+  def rewrite(self):
+    with open(self.journal + '.tmp', 'w') as f:
+      for message, _ in self.messages:
+        f.write(json.dumps(message, separators=(',', ':')) + "\n")
+    os.replace(self.journal + '.tmp', self.journal)
+
+  def persist(self):
+    """Copy the journal to persistent storage, if it has changed since the last copy."""
+    if self.persistent_copy is None or not self.dirty:
+      return
+    with self.persist_lock:
+      # Only a snapshot of the journal is taken under the lock: remounting
+      # the persistent storage can take many seconds, and append() mustn't
+      # wait for it
+      snapshot = self.journal + '.persist'
+      with self.lock:
+        try:
+          shutil.copyfile(self.journal, snapshot)
+        except OSError:
+          return
+        self.dirty = False
+      try:
+        copied = subprocess.run(['kvmd-pstrun', '--', 'cp', snapshot, self.persistent_copy], capture_output=True, timeout=60).returncode == 0
+      except (OSError, subprocess.TimeoutExpired):
+        copied = False
+      # Tried again next time if the copy failed
+      if not copied:
+        self.dirty = True
@@ -0,0 +1,60 @@
+import json, math, functools
+from datetime import datetime
+
+# The last timestamp formatted, as (whole second, ISO string as bytes), since
+# most readings in a cycle are taken within the same second
+_last_timestamp = (None, b'')
+
+
+def iso_timestamp(sampled: float) -> bytes:
+  global _last_timestamp
+  second = int(sampled)
+  if _last_timestamp[0] != second:
+    _last_timestamp = (second, datetime.fromtimestamp(second).isoformat(timespec='seconds').encode())
+  return _last_timestamp[1]
+
+
+def encode_value(value) -> bytes:
+  # Numbers are by far the most common readings, and repr() gives the same
+  # result as json.dumps() for them
+  if type(value) is float and math.isfinite(value):
+    return float.__repr__(value).encode()
+  if type(value) is int:
+    return int.__repr__(value).encode()
+  return json.dumps(value).encode()
+
+
+class PublishPlan:
+  """
+  Everything update() needs to read, correct and publish one sensor, worked
+  out once when the sensors are loaded instead of on every cycle.
+  """
+  __slots__ = ('state_topic', 'status_topic', 'read', 'offset', 'precision', 'aggregate_key')
+
+  def __init__(self, sensor: dict):
+    self.state_topic = "sensors/{}/state".format(sensor['id'])
+    self.status_topic = "sensors/{}/status".format(sensor['id'])
+    self.read = None  # see bind()
+    self.offset = sensor['device_offset']
+    self.precision = sensor['output_precision']
+    # The key for this sensor's reading in an aggregate state document
+    self.aggregate_key = json.dumps(sensor['name']).encode() + b': '
+
+  def bind(self, instance, device_property: str):
+    """Set up the reader, once the sensor type has been constructed."""
+    # A property's getter is bound directly, skipping the lookup by name
+    attribute = getattr(type(instance), device_property, None)
+    if isinstance(attribute, property):
+      self.read = attribute.fget.__get__(instance)
+    else:
+      self.read = functools.partial(getattr, instance, device_property)
+
+  def correct(self, value):
+    return value + self.offset if self.offset is not None else value
+
+  def round(self, value):
+    return round(value, self.precision)
+
+  def serialise(self, sampled: float, value) -> bytes:
+    """The reading as JSON, byte for byte as json.dumps() would give it."""
+    return b'{"timestamp": "' + iso_timestamp(sampled) + b'", "value": ' + encode_value(value) + b'}'
@@ -0,0 +1,241 @@
+import os, json, time, queue, threading
+import requests
+
+
+class Sink:
+  """
+  Somewhere readings go. update() hands every sink each reading it
+  publishes, then calls flush() once the cycle's readings are all in.
+  """
+  name = None
+
+  def submit(self, sensor: dict, value, sampled: float):
+    raise NotImplementedError
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+  def queued(self):
+    """How many readings are waiting to be written."""
+    return 0
+
+
+class MQTTSink(Sink):
+  """
+  Readings published to each sensor's state topic, or in aggregate mode
+  gathered into one message per host, sent at the end of the cycle. The
+  MQTT client queues and sends messages on its own thread, and the outbox
+  holds them while the broker is unreachable, so this sink needs no queue
+  of its own.
+  """
+  name = 'mqtt'
+
+  def __init__(self, publish, aggregate: bool = False):
+    self.publish = publish
+    self.aggregate = aggregate
+    # The latest reading of every sensor, by host state topic, in aggregate mode
+    self.aggregate_state = {}
+    self.updated = set()
+
+  def submit(self, sensor, value, sampled):
+    plan = sensor['plan']
+    reading = plan.serialise(sampled, value)
+    if self.aggregate:
+      state_topic = sensor['host']['state_topic']
+      self.aggregate_state.setdefault(state_topic, {})[sensor['name']] = plan.aggregate_key + reading
+      self.updated.add(state_topic)
+    else:
+      self.publish(topic=plan.state_topic, payload=reading, buffer=True)
+
+  def flush(self):
+    for state_topic in self.updated:
+      self.publish(topic=state_topic, payload=b'{' + b', '.join(self.aggregate_state[state_topic].values()) + b'}', buffer=True)
+    self.updated.clear()
+
+  def forget(self, sensor):
+    """Leave a removed sensor out of aggregate messages from now on."""
+    self.aggregate_state.get(sensor['host']['state_topic'], {}).pop(sensor['name'], None)
+
+
+class QueuedSink(Sink):
+  """
+  A sink that writes on its own thread, in batches of up to batch_size
+  readings, or whatever has arrived every flush_interval seconds. Its queue
+  is bounded, so a sink that falls behind (or whose destination is down)
+  drops readings rather than ever holding up update(). A batch that fails
+  to be written is tried again with the next one.
+  """
+
+  def __init__(self, name: str, batch_size: int = 500, flush_interval: float = 10, max_queued: int = 10000, diagnostics=None):
+    self.name = name
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.max_queued = max_queued
+    self.diagnostics = diagnostics
+    self.queue = queue.Queue(max_queued)
+    self.pending = []
+    self.failing = False
+    self.closing = threading.Event()
+    self.thread = threading.Thread(target=self.run, name="sink-{}".format(name), daemon=True)
+    self.thread.start()
+
+  def submit(self, sensor, value, sampled):
+    # Only what the sink needs is queued, not the sensor itself
+    try:
+      self.queue.put_nowait((sampled, sensor['host']['unique_id'], sensor['name'], value))
+    except queue.Full:
+      self.drop(1)
+
+  def queued(self):
+    return self.queue.qsize() + len(self.pending)
+
+  def drop(self, count):
+    if self.diagnostics is not None:
+      self.diagnostics.count("sink_dropped.{}".format(self.name), count)
+
+  def run(self):
+    deadline = time.monotonic() + self.flush_interval
+    while not self.closing.is_set():
+      try:
+        self.pending.append(self.queue.get(timeout=max(0, min(deadline - time.monotonic(), 1))))
+      except queue.Empty:
+        pass
+      # After a failure, nothing is tried again until the next interval
+      if (len(self.pending) >= self.batch_size and not self.failing) or time.monotonic() >= deadline:
+        self.write_pending()
+        deadline = time.monotonic() + self.flush_interval
+    self.write_pending()
+
+  def write_pending(self):
+    while True:
+      try:
+        self.pending.append(self.queue.get_nowait())
+      except queue.Empty:
+        break
+    if not self.pending:
+      return
+    # Readings that couldn't be written are kept for the next batch, up to
+    # the size of the queue
+    if len(self.pending) > self.max_queued:
+      self.drop(len(self.pending) - self.max_queued)
+      del self.pending[:len(self.pending) - self.max_queued]
+    started = time.perf_counter()
+    try:
+      self.write(self.pending)
+      self.pending = []
+      self.failing = False
+    except (OSError, ValueError):
+      self.failing = True
+      if self.diagnostics is not None:
+        self.diagnostics.count("sink_errors.{}".format(self.name))
+    finally:
+      if self.diagnostics is not None:
+        self.diagnostics.observe("sink_write.{}".format(self.name), time.perf_counter() - started)
+
+  def close(self, timeout: float = 10):
+    """Stop the thread, once it has written whatever is left."""
+    self.closing.set()
+    self.thread.join(timeout)
+
+  def write(self, readings):
+    """Write (sampled, host, name, value) readings; raises OSError or ValueError on failure."""
+    raise NotImplementedError
+
+
+class InfluxDBSink(QueuedSink):
+  """
+  Readings written to InfluxDB in line protocol, as one measurement with the
+  host and sensor as tags. InfluxDB fixes each field's type across the whole
+  measurement, so numbers (and binary sensors' ON/OFF, as 1 or 0) are
+  written to the 'value' field, and any other text to 'state'. The url is
+  the full write endpoint, e.g. http://influxdb:8086/api/v2/write?org=home&bucket=pikvm
+  (or /write?db=pikvm for InfluxDB 1.x).
+  """
+
+  def __init__(self, url: str, token: str = None, measurement: str = 'sensors', timeout: float = 10, **kwargs):
+    self.url = url
+    self.measurement = self.escape(measurement, ', ')
+    self.timeout = timeout
+    self.session = requests.Session()
+    if token is not None:
+      self.session.headers.update({'Authorization': "Token {}".format(token)})
+    super().__init__(**kwargs)
+
+  @staticmethod
+  def escape(text, special):
+    text = str(text).replace('\\', '\\\\')
+    for character in special:
+      text = text.replace(character, '\\' + character)
+    return text
+
+  binary_states = { 'ON': 1.0, 'OFF': 0.0 }
+
+  def field(self, value):
+    # Numbers are always written as floats, so that a sensor reading a whole
+    # number now and then doesn't change the field's type
+    if isinstance(value, bool):
+      value = float(value)
+    elif isinstance(value, str) and value in self.binary_states:
+      value = self.binary_states[value]
+    if isinstance(value, (int, float)):
+      return "value={}".format(repr(float(value)))
+    return 'state="{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+  def write(self, readings):
+    lines = []
+    for sampled, host, name, value in readings:
+      if value is None:
+        continue
+      lines.append("{},host={},sensor={} {} {}".format(
+        self.measurement, self.escape(host, ',= '), self.escape(name, ',= '), self.field(value), int(sampled * 1e9)))
+    if not lines:
+      return
+    try:
+      response = self.session.post(self.url, data="\n".join(lines).encode(), timeout=self.timeout)
+    except requests.RequestException as error:
+      raise OSError(str(error))
+    # A batch InfluxDB rejects (e.g. a field type conflict) would only be
+    # rejected again, so it is dropped; anything else is tried again
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+      self.drop(len(readings))
+      if self.diagnostics is not None:
+        self.diagnostics.count("sink_errors.{}".format(self.name))
+    elif response.status_code >= 300:
+      raise OSError("{} {}".format(response.status_code, response.reason))
+
+
+class FileSink(QueuedSink):
+  """
+  Readings appended to a local file for offline analysis, one compact JSON
+  array of [timestamp, host, sensor, value] per line. When the file grows
+  past max_bytes it is rotated, keeping up to backups older files (path.1
+  is the most recent of them).
+  """
+
+  def __init__(self, path: str, max_bytes: int = 1048576, backups: int = 3, **kwargs):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.backups = backups
+    if os.path.dirname(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+    super().__init__(**kwargs)
+
+  def write(self, readings):
+    with open(self.path, 'a') as f:
+      for sampled, host, name, value in readings:
+        f.write(json.dumps([round(sampled, 3), host, name, value], separators=(',', ':')) + "\n")
+      size = f.tell()
+    if size > self.max_bytes:
+      self.rotate()
+
+  def rotate(self):
+    for index in range(self.backups - 1, 0, -1):
+      if os.path.exists("{}.{}".format(self.path, index)):
+        os.replace("{}.{}".format(self.path, index), "{}.{}".format(self.path, index + 1))
+    if self.backups > 0:
+      os.replace(self.path, "{}.1".format(self.path))
+    else:
+      os.remove(self.path)
@@ -1,77 +1,102 @@
 #!/usr/bin/env python3
-import sys, socket
+import os, sys, socket, signal, threading
 import netifaces
-import json, yaml, time
-import re, uuid
+import json, yaml, time, heapq, itertools, statistics, queue
+import re, uuid, hashlib, random
 from datetime import datetime
 from typing import List, Optional
-from retrying import retry, RetryError
-import importlib
+import importlib, importlib.util, importlib.metadata
+from concurrent.futures import ThreadPoolExecutor
 import paho.mqtt.client as mqtt
-import kvmd
 from sensor_types.measurementerror import MeasurementError
+from sensor_types import rpi
+from outputs.outbox import Outbox
+from outputs.diagnostics import Diagnostics
+from outputs.publishplan import PublishPlan
+from outputs.sinks import MQTTSink, InfluxDBSink, FileSink
+from outputs import memory
 
 
-def get_rpi_serial():
-  cpuserial = "0000000000000000"
-  try:
-    f = open('/sys/firmware/devicetree/base/serial-number','r')
-    cpuserial = f.readline().rstrip('\x00')
-    f.close()
-  except:
-    cpuserial = "ERROR000000000"
-  return cpuserial
-
-def get_rpi_model():
-  model = "Unknown model"
-  try:
-    f = open('/sys/firmware/devicetree/base/model','r')
-    model = f.readline().rstrip('\x00')
-    f.close()
-  except:
-    model = "Error (unknown model)"
-  return model
-
-def get_rpi_hw():
-  hw = "Unknown"
-  try:
-    f = open('/proc/cpuinfo','r')
-    for line in f:
-      if line[0:8]=='Hardware':
-        hw = line[10:26].strip()
-    f.close()
-  except:
-    hw = "Error (unknown hardware)"
-  return hw
-
-def get_rpi_hw_revision():
-  rev = "000000"
-  try:
-    f = open('/proc/cpuinfo','r')
-    for line in f:
-      if line[0:8]=='Revision':
-        rev = line[10:26].strip()
-    f.close()
-  except:
-    rev = "ERROR000000"
-  return rev
-
 def get_kvmd_server_host():
   server = "N/A"
-  with open("/etc/kvmd/meta.yaml", "r") as kvmd_meta:
-    try:
+  try:
+    with open("/etc/kvmd/meta.yaml", "r") as kvmd_meta:
       api_info = yaml.safe_load(kvmd_meta)
       server = api_info['server']['host']
-    except yaml.YAMLError as e:
-      server = "{host}.local".format(host=socket.gethostname())
+  except (IOError, yaml.YAMLError) as e:
+    server = "{host}.local".format(host=socket.gethostname())
   return server
 
+def get_kvmd_version():
+  # Read from the package metadata, rather than importing kvmd
+  try:
+    return importlib.metadata.version('kvmd')
+  except importlib.metadata.PackageNotFoundError:
+    return "unknown"
+
+def get_host_identity(cache_file):
+  """The hardware and host identity, cached in cache_file until the next boot."""
+  try:
+    with open('/proc/sys/kernel/random/boot_id', 'r') as f:
+      boot_id = f.read().strip()
+  except IOError:
+    boot_id = None
+  try:
+    with open(cache_file, 'r') as f:
+      identity = json.load(f)
+    if boot_id is not None and identity['boot_id'] == boot_id:
+      return identity
+  except (IOError, ValueError, KeyError):
+    pass
+  identity = {
+    'boot_id':      boot_id,
+    'serial':       rpi.serial_number(),
+    'model':        rpi.model(),
+    'hardware':     rpi.hardware(),
+    'revision':     rpi.hardware_revision(),
+    'server_host':  get_kvmd_server_host()
+  }
+  # Don't hold on to a failed read of the serial number until the next boot
+  if boot_id is not None and not identity['serial'].startswith("ERROR"):
+    try:
+      os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+      with open(cache_file, 'w') as f:
+        json.dump(identity, f)
+    except IOError:
+      pass
+  return identity
+
+def get_process_age():
+  """Seconds since this process was started."""
+  with open('/proc/self/stat', 'r') as f:
+    start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+  with open('/proc/uptime', 'r') as f:
+    uptime = float(f.read().split()[0])
+  return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+def sd_notify(state):
+  """Send a state notification to systemd, when running as a Type=notify service."""
+  address = os.environ.get('NOTIFY_SOCKET')
+  if not address:
+    return
+  if address[0] == '@':
+    address = '\0' + address[1:]
+  with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+    s.connect(address)
+    s.sendall(state.encode())
+
 
 class PiKVMHASensors:
 
   default_config = {      
     'update_period':          30,
     'valid_time':             600,
+    'read_workers':           8,
+    'spread_reads':           True,
+    'read_timeout':           10,
+    'breaker_threshold':      3,     # consecutive failed cycles before a device is backed off
+    'breaker_backoff':        30,
+    'breaker_max_backoff':    1800,
     'verbose':                False,
     'mqtt_broker':            None,  # Must be overridden
     'mqtt_port':              1883,
@@ -80,36 +105,122 @@ class PiKVMHASensors:
     'mqtt_username':          None,
     'mqtt_password':          None,
     'mqtt_ha_prefix':         'homeassistant',
+    'mqtt_aggregate_state':   False,
+    'mqtt_discovery':         'entity',  # 'entity' (one config per sensor) or 'device' (one config for them all)
+    'discovery_cache':        '/run/pikvm-ha-sensors/discovery.json',
     'pikvm_username':         'admin',
     'pikvm_password':         None,  # Must be overridden (unless auth is disabled)
-    'prometheus_url':         None
+    'kvmd_events':            True,
+    'kvmd_socket':            '/run/kvmd/kvmd.sock',  # null to go through nginx instead
+    'prometheus_url':         None,
+    'identity_cache':         '/run/pikvm-ha-sensors/identity.json',
+    'outbox_journal':         '/run/pikvm-ha-sensors/outbox.jsonl',  # null to drop readings while disconnected
+    'outbox_persistent_copy': '/var/lib/kvmd/pst/data/pikvm-ha-sensors/outbox.jsonl',
+    'outbox_max_bytes':       1048576,
+    'outbox_batch_size':      50,
+    'outbox_batch_interval':  1,
+    'outbox_persist_interval': 300,
+    'diagnostic_entities':    False,
+    'diagnostics_period':     300,
+    'diagnostics_dump':       '/run/pikvm-ha-sensors/diagnostics.json',  # written on SIGUSR1
+    'memory_budget':          None,  # MiB; null for no limit
+    'tracemalloc':            False, # trace allocations from startup, rather than from the first SIGUSR2
+    'tracemalloc_top':        10,    # lines of code listed in each SIGUSR2 report
+    'mqtt_connect_timeout':   30,
+    'mqtt_reconnect_min_delay': 1,
+    'mqtt_reconnect_max_delay': 120,
+    'mqtt_max_inflight':      20,    # QoS 1 messages awaiting acknowledgement
+    'mqtt_max_queued':        1000,  # messages held by the client beyond that
+    'fleet':                  [],    # other hosts to monitor, each a device of its own; see config.sample.yaml
+    'sinks':                  []     # outputs for readings besides MQTT; see config.sample.yaml
+  }
+
+  # Outputs that readings can be written to as well as MQTT, by type
+  sink_types = {
+    'influxdb':           InfluxDBSink,
+    'file':               FileSink
+  }
+
+  # Optional Home Assistant entities summarising the diagnostics: title, units, device class, state class
+  diagnostic_entities = {
+    'cycle_time_p90':     ("Update cycle time (p90)", "ms", "duration", "measurement"),
+    'slowest_read_p90':   ("Slowest sensor read (p90)", "ms", "duration", "measurement"),
+    'read_errors':        ("Sensor read errors", None, None, "total_increasing"),
+    'overruns':           ("Update cycle overruns", None, None, "total_increasing"),
+    'missed_deadlines':   ("Missed read deadlines", None, None, "total_increasing"),
+    'mqtt_queue':         ("MQTT messages queued", None, None, "measurement"),
+    'memory_rss':         ("Memory used (RSS)", "MiB", "data_size", "measurement"),
+    'python_heap':        ("Python heap", "MiB", "data_size", "measurement")
+  }
+
+  # Home Assistant's abbreviations for discovery keys, used in device discovery
+  discovery_abbreviations = {
+    'availability':                 'avty',
+    'availability_mode':            'avty_mode',
+    'availability_topic':           'avty_t',
+    'configuration_url':            'cu',
+    'connections':                  'cns',
+    'device':                       'dev',
+    'device_class':                 'dev_cla',
+    'entity_category':              'ent_cat',
+    'expire_after':                 'exp_aft',
+    'force_update':                 'frc_upd',
+    'hw_version':                   'hw',
+    'icon':                         'ic',
+    'identifiers':                  'ids',
+    'json_attributes_topic':        'json_attr_t',
+    'manufacturer':                 'mf',
+    'model':                        'mdl',
+    'object_id':                    'obj_id',
+    'origin':                       'o',
+    'platform':                     'p',
+    'state_class':                  'stat_cla',
+    'state_topic':                  'stat_t',
+    'suggested_display_precision':  'sug_dsp_prc',
+    'sw_version':                   'sw',
+    'topic':                        't',
+    'unique_id':                    'uniq_id',
+    'unit_of_measurement':          'unit_of_meas',
+    'value_template':               'val_tpl',
+    'components':                   'cmps',
+    'support_url':                  'url'
   }
 
-  unique_id = 'pikvm_{}'.format(get_rpi_serial()[-6:]) # suffix is last six digits of serial number
-  device_info = {
-    'identifiers':        [
-                            socket.gethostname(),
-                            unique_id,
-                            get_rpi_serial()
-                          ],
-    'connections':        [],
-    'manufacturer':       "pikvm.org",
-    'model':              "PiKVM ({rpi_model})".format(rpi_model=get_rpi_model()),
-    'hw_version':         "{hardware} (rev {revision})".format(hardware=get_rpi_hw(), revision=get_rpi_hw_revision()),
-    'sw_version':         "kvmd v{kvmd_version}".format(kvmd_version=kvmd.__version__),
-    'name':               "PiKVM - open-source DIY IP-KVM",
-    'configuration_url':  "https://{host}".format(host=get_kvmd_server_host())
+  origin_info = {
+    'name':               "pikvm-ha-sensors",
+    'support_url':        "https://github.com/imgrant/pikvm-ha-sensors"
+  }
+
+  aggregate_functions = {
+    'mean':               statistics.fmean,
+    'min':                min,
+    'max':                max
   }
 
   sensors = []
   sensor_template = {
     'name':               None,
     'id':                 None,
+    'host':               None,
     'instance':           None,
+    'plan':               None,
+    'device_key':         None,
     'device_type':        None,
     'device_address':     None,
     'device_property':    None,
+    'device_options':     None,
     'device_offset':      None,
+    'update_period':      None,
+    'update_phase':       None,
+    'update_period_min':  None,
+    'update_period_max':  None,
+    'sensitivity':        None,
+    'read_timeout':       None,
+    'aggregate_samples':  None,
+    'aggregate_function': 'mean',
+    'deadband':           None,
+    'deadband_percent':   None,
+    'max_silence':        None,
     'units':              None,
     'output_precision':   None,
     'display_precision':  None,
@@ -121,26 +232,272 @@ class PiKVMHASensors:
   } 
 
 
-  def __init__(self, user_config, sensors):
+  # Settings that are only read when the service starts, so changing them
+  # needs a restart rather than a reload
+  restart_config = ('mqtt_broker', 'mqtt_port', 'mqtt_transport', 'mqtt_use_tls', 'mqtt_username', 'mqtt_password',
+                    'mqtt_ha_prefix', 'mqtt_discovery', 'discovery_cache', 'mqtt_max_inflight', 'mqtt_max_queued',
+                    'pikvm_username', 'pikvm_password', 'kvmd_events', 'kvmd_socket', 'prometheus_url', 'identity_cache',
+                    'read_workers', 'outbox_journal', 'outbox_persistent_copy', 'outbox_max_bytes', 'memory_budget',
+                    'tracemalloc', 'fleet', 'sinks')
+
+  def __init__(self, user_config, sensors, config_file=None, sensors_file=None):
     # Merge user config with base config parameters;
     self.config = { **self.default_config, **user_config }
-    # Overlay sensors dict on base sensor template dict
-    for sensor in sensors:
-      s = self.sensor_template | sensor
-      s['id'] = "{unique_id}_{sensor_name}".format(unique_id=self.unique_id, sensor_name=sensor['name'])
-      self.sensors.append(s)
+    # Where the configuration came from, to reload it on SIGHUP
+    self.config_file     = config_file
+    self.sensors_file    = sensors_file
+    identity = get_host_identity(self.config['identity_cache'])
+    self.unique_id = 'pikvm_{}'.format(identity['serial'][-6:]) # suffix is last six digits of serial number
+    self.device_info = {
+      'identifiers':        [
+                              socket.gethostname(),
+                              self.unique_id,
+                              identity['serial']
+                            ],
+      'connections':        [],
+      'manufacturer':       "pikvm.org",
+      'model':              "PiKVM ({rpi_model})".format(rpi_model=identity['model']),
+      'hw_version':         "{hardware} (rev {revision})".format(hardware=identity['hardware'], revision=identity['revision']),
+      'sw_version':         "kvmd v{kvmd_version}".format(kvmd_version=get_kvmd_version()),
+      'name':               "PiKVM - open-source DIY IP-KVM",
+      'configuration_url':  "https://{host}".format(host=identity['server_host'])
+    }
+    # The PiKVM itself is the first of the hosts whose sensors are read, and
+    # the only one unless it monitors a fleet of others
+    self.host = {
+      'name':               None,
+      'unique_id':          self.unique_id,
+      'device_info':        self.device_info,
+      'config':             {},
+      'state_topic':        "sensors/{}/state".format(self.unique_id)
+    }
+    fleet, errors = self.build_fleet(self.config)
+    self.hosts = [self.host] + [host for host, _ in fleet]
+    self.sensors = self.build_sensors(self.config, sensors, self.host)
+    for host, host_sensors in fleet:
+      self.sensors += self.build_sensors(self.config, host_sensors, host)
+    # Report every mistake in the configuration now, rather than the first
+    # one to be hit part way through a cycle
+    errors += self.validate_config(self.config, self.sensors)
+    if errors:
+      self.error("Invalid configuration:\n  {}".format("\n  ".join(errors)))
     self.mqtt_client     = None
     self.mqtt_connected  = False
+    self.mqtt_failures   = 0
+    self.mqtt_ready      = threading.Event()
+    self.status_topic    = "sensors/{}/status".format(self.unique_id)
+    self.diagnostics_topic = "sensors/{}/diagnostics".format(self.unique_id)
+    self.diagnostics     = Diagnostics()
+    self.availability    = {}
+    # Every reading goes to each sink: MQTT first, then any others configured
+    self.mqtt_sink       = MQTTSink(self.publish_message, self.config['mqtt_aggregate_state'])
+    self.sinks           = [self.mqtt_sink]
+    for entry in self.config['sinks']:
+      options = { key: value for key, value in entry.items() if key != 'type' }
+      options['name'] = entry.get('name') or entry['type']
+      try:
+        self.sinks.append(self.sink_types[entry['type']](diagnostics=self.diagnostics, **options))
+      except (TypeError, OSError) as e:
+        self.error("Invalid configuration:\n  Sink {}: {}".format(options['name'], str(e)))
+    self.filters         = {}
+    self.outbox          = None
+    if self.config['outbox_journal'] is not None:
+      self.outbox = Outbox(self.config['outbox_journal'], self.config['outbox_persistent_copy'], self.outbox_max_bytes)
+    self.memory_tracer   = memory.MemoryTracer(self.config['tracemalloc_top'])
+    if self.config['tracemalloc']:
+      self.memory_tracer.start()
+    self.over_budget     = False
+    self.memory_trimmed  = None
     self.ha_registered   = False
+    self.discovery_hashes = {}
+    self.published_components = {}
+    self.discovery_lock  = threading.Lock()
+    self.migrating       = set()
+    self.migration       = None
+    self.migration_lock  = threading.Lock()
+    self.reload_requested = False
+    self.dump_requested  = False
+    self.memory_report_requested = False
+    try:
+      with open(self.config['discovery_cache'], 'r') as f:
+        cache = json.load(f)
+      # Older caches held only the hashes
+      if 'hashes' not in cache:
+        cache = { 'hashes': cache }
+      self.discovery_hashes = cache['hashes']
+      self.published_components = cache.get('components', {})
+    except (IOError, ValueError, TypeError):
+      pass
     self.worker          = None
+    self.devices         = {}
+    self.device_attributes = {}
+    self.unidentified    = set()
+    self.executor        = ThreadPoolExecutor(max_workers=self.config['read_workers'], thread_name_prefix='reader')
+    self.schedule        = []
+    self.schedule_seq    = itertools.count()
+    self.periods         = {}
+    self.missed_deadlines = {}
+    self.bus_jobs        = {}
+    self.breakers        = {}
+    self.triggered       = set()
+    self.trigger_lock    = threading.Lock()
+    self.wakeup          = threading.Event()
     self.device_info['connections'] = [
                                         [ "mac_address", ':'.join(re.findall('..', '%012x' % uuid.getnode())).lower() ],
                                         [ "ipv4_address", netifaces.ifaddresses('eth0')[netifaces.AF_INET][0]['addr'] ],
                                         [ "ipv6_address", netifaces.ifaddresses('eth0')[netifaces.AF_INET6][0]['addr'] ],
                                         [ "fqdn",         socket.getfqdn() ],
-                                        [ "server_host",  get_kvmd_server_host() ]
+                                        [ "server_host",  identity['server_host'] ]
                                       ]
 
+  def build_fleet(self, config):
+    # Each host in the fleet is a device of its own in Home Assistant, with
+    # its own sensors file. Its other settings override the global ones for
+    # its sensors, e.g. prometheus_url, update_period or read_timeout
+    fleet = []
+    errors = []
+    for index, entry in enumerate(config['fleet']):
+      if not isinstance(entry, dict) or entry.get('name') is None or entry.get('sensors') is None:
+        errors.append("Fleet host {}: name and sensors are required".format(index + 1))
+        continue
+      name = entry['name']
+      if name in [host['name'] for host, _ in fleet]:
+        errors.append("Fleet host {}: the name is used more than once".format(name))
+        continue
+      try:
+        with open(entry['sensors'], 'r') as yamlsensors:
+          sensors = yaml.safe_load(yamlsensors) or []
+      except (IOError, yaml.YAMLError) as e:
+        errors.append("Fleet host {}: {}".format(name, str(e)))
+        continue
+      unique_id = entry.get('unique_id') or "{}_{}".format(self.unique_id, name)
+      device_info = {
+        'identifiers':      [ unique_id ],
+        'name':             entry.get('title') or name,
+        'via_device':       self.unique_id
+      }
+      for key in ('manufacturer', 'model', 'configuration_url'):
+        if entry.get(key) is not None:
+          device_info[key] = entry[key]
+      host = {
+        'name':             name,
+        'unique_id':        unique_id,
+        'device_info':      device_info,
+        'config':           { key: value for key, value in entry.items() if key in self.default_config },
+        'state_topic':      "sensors/{}/state".format(unique_id)
+      }
+      fleet.append((host, sensors))
+    return fleet, errors
+
+  def build_sensors(self, config, sensors, host):
+    built = []
+    config = config | host['config']
+    # Overlay sensors dict on base sensor template dict
+    for sensor in sensors:
+      s = self.sensor_template | sensor
+      s['id'] = "{unique_id}_{sensor_name}".format(unique_id=host['unique_id'], sensor_name=sensor['name'])
+      s['host'] = host
+      if s['update_period'] is None:
+        s['update_period'] = config['update_period']
+      if s['read_timeout'] is None:
+        s['read_timeout'] = config['read_timeout']
+      # Readings held back by a deadband are still republished in time to
+      # stop Home Assistant expiring the entity
+      if s['max_silence'] is None and (s['deadband'] is not None or s['deadband_percent'] is not None):
+        s['max_silence'] = config['valid_time'] / 2
+      # Sensors with a sensitivity adapt their period between these bounds,
+      # but are always read often enough to be published within valid_time
+      if s['sensitivity'] is not None:
+        if s['update_period_min'] is None:
+          s['update_period_min'] = s['update_period'] / 10
+        if s['update_period_max'] is None:
+          s['update_period_max'] = config['valid_time'] / 2
+        else:
+          s['update_period_max'] = min(s['update_period_max'], config['valid_time'] / 2)
+      s['plan'] = PublishPlan(s)
+      built.append(s)
+    return built
+
+  def validate_config(self, config, sensors):
+    errors = []
+    def number(value, minimum=None):
+      return isinstance(value, (int, float)) and not isinstance(value, bool) and (minimum is None or value > minimum)
+    if config['mqtt_broker'] is None:
+      errors.append("mqtt_broker must be set")
+    if config['mqtt_discovery'] not in ('entity', 'device'):
+      errors.append("mqtt_discovery must be 'entity' or 'device'")
+    for key in ('update_period', 'valid_time', 'read_timeout'):
+      if not number(config[key], 0):
+        errors.append("{} must be a number greater than 0".format(key))
+    if config['memory_budget'] is not None and not number(config['memory_budget'], 0):
+      errors.append("memory_budget must be null or a number of MiB greater than 0")
+    sink_names = set()
+    for index, entry in enumerate(config['sinks']):
+      if not isinstance(entry, dict) or entry.get('type') not in self.sink_types:
+        errors.append("Sink {}: type must be one of {}".format(index + 1, ", ".join(self.sink_types)))
+        continue
+      name = entry.get('name') or entry['type']
+      if name in sink_names:
+        errors.append("Sink {}: the name is used more than once".format(name))
+      sink_names.add(name)
+      for key in { 'influxdb': ('url',), 'file': ('path',) }[entry['type']]:
+        if entry.get(key) is None:
+          errors.append("Sink {}: {} is required".format(name, key))
+    # Names need only be unique on each host, but the ids made from them
+    # (the host's unique_id and the name) must be unique across them all
+    ids = set()
+    for s in sensors:
+      name = s['name']
+      for key in ('name', 'device_type', 'device_property', 'ha_component_type', 'ha_title'):
+        if s[key] is None:
+          errors.append("Sensor {}: {} is required".format(name, key))
+      if s['id'] in ids:
+        errors.append("Sensor {}: the id {} is used more than once".format(name, s['id']))
+      ids.add(s['id'])
+      for key in ('update_period', 'read_timeout'):
+        if not number(s[key], 0):
+          errors.append("Sensor {}: {} must be a number greater than 0".format(name, key))
+      for key in ('update_period_min', 'update_period_max', 'sensitivity'):
+        if s[key] is not None and not number(s[key], 0):
+          errors.append("Sensor {}: {} must be a number greater than 0".format(name, key))
+      if number(s['update_period_min'], 0) and number(s['update_period_max'], 0) and s['update_period_min'] > s['update_period_max']:
+        errors.append("Sensor {}: update_period_min is greater than update_period_max".format(name))
+      for key in ('device_offset', 'update_phase', 'deadband', 'deadband_percent', 'max_silence'):
+        if s[key] is not None and not number(s[key]):
+          errors.append("Sensor {}: {} must be a number".format(name, key))
+      for key, minimum in (('output_precision', None), ('aggregate_samples', 0)):
+        if s[key] is not None and not (isinstance(s[key], int) and (minimum is None or s[key] > minimum)):
+          errors.append("Sensor {}: {} must be a whole number{}".format(name, key, "" if minimum is None else " greater than {}".format(minimum)))
+      if s['aggregate_function'] not in self.aggregate_functions:
+        errors.append("Sensor {}: unknown aggregate_function {}".format(name, s['aggregate_function']))
+      if s['device_type'] is not None and s['device_property'] is not None:
+        if importlib.util.find_spec("sensor_types.{}".format(s['device_type'])) is None:
+          errors.append("Sensor {}: unknown device_type {}".format(name, s['device_type']))
+        else:
+          try:
+            SensorClass = getattr(importlib.import_module("sensor_types.{}".format(s['device_type'])), s['device_type'], None)
+          except Exception as e:
+            errors.append("Sensor {}: unable to load device_type {} ({})".format(name, s['device_type'], str(e) or type(e).__name__))
+            continue
+          if SensorClass is None or not hasattr(SensorClass, s['device_property']):
+            errors.append("Sensor {}: device_type {} has no property {}".format(name, s['device_type'], s['device_property']))
+    return errors
+
+  # With a memory budget, the outbox (held in memory and again in its journal
+  # on tmpfs) and the MQTT client's queue are each held to a share of it
+  @property
+  def outbox_max_bytes(self):
+    if self.config['memory_budget'] is None:
+      return self.config['outbox_max_bytes']
+    return min(self.config['outbox_max_bytes'], int(self.config['memory_budget'] * memory.MIB / 16))
+
+  @property
+  def mqtt_max_queued(self):
+    # A queued message takes about a kilobyte, with paho's bookkeeping
+    if self.config['memory_budget'] is None:
+      return self.config['mqtt_max_queued']
+    return min(self.config['mqtt_max_queued'], int(self.config['memory_budget'] * memory.MIB / 8 / 1024))
+
   def info(self, message):
     if self.config['verbose'] == True:
       print("{}".format(message))
@@ -164,115 +521,443 @@ class PiKVMHASensors:
       p=self.transport_to_protocol(self.config['mqtt_transport']),
       t="s" if self.config['mqtt_use_tls'] else ""
     )
-    if self.mqtt_broker_reachable():
-      self.info("Connecting to MQTT broker at {p}{h} ...".format(p=protocol, h=broker))
-      self.mqtt_client = mqtt.Client(client_id=self.unique_id, transport=self.config['mqtt_transport'])
-      if self.config['mqtt_username'] is not None and self.config['mqtt_password'] is not None:
-        self.mqtt_client.username_pw_set(self.config['mqtt_username'], self.config['mqtt_password'])
-      if self.config['mqtt_use_tls'] is True:
-        self.mqtt_client.tls_set()
-      self.mqtt_client.on_connect = self.mqtt_on_connect
-      self.mqtt_client.on_disconnect = self.mqtt_on_disconnect
-      try:
-        self.mqtt_client.connect(self.config['mqtt_broker'], int(self.config['mqtt_port']), 30)
-        self.mqtt_client.loop_start()
-      except Exception as e:
-        self.error("MQTT client error: {}".format(str(e)))
-    else:
-      self.error("Unable to reach MQTT broker at {}".format(broker))
+    self.info("Connecting to MQTT broker at {p}{h} ...".format(p=protocol, h=broker))
+    # One client for the life of the service, with a persistent session, so
+    # that the broker keeps its subscriptions and unacknowledged messages
+    # across reconnects
+    self.mqtt_client = mqtt.Client(client_id=self.unique_id, transport=self.config['mqtt_transport'], clean_session=False)
+    if self.config['mqtt_username'] is not None and self.config['mqtt_password'] is not None:
+      self.mqtt_client.username_pw_set(self.config['mqtt_username'], self.config['mqtt_password'])
+    if self.config['mqtt_use_tls'] is True:
+      self.mqtt_client.tls_set()
+    self.mqtt_client.max_inflight_messages_set(self.config['mqtt_max_inflight'])
+    self.mqtt_client.max_queued_messages_set(self.mqtt_max_queued)
+    # The broker marks the whole device unavailable if the connection is lost
+    self.mqtt_client.will_set(self.status_topic, payload="offline", qos=1, retain=True)
+    self.mqtt_client.on_connect = self.mqtt_on_connect
+    self.mqtt_client.on_connect_fail = self.mqtt_on_connect_fail
+    self.mqtt_client.on_disconnect = self.mqtt_on_disconnect
+    # An exception in a callback is logged, rather than ending the network loop
+    self.mqtt_client.suppress_exceptions = True
+    self.mqtt_client.enable_logger()
+    self.mqtt_client.message_callback_add("{}/status".format(self.config['mqtt_ha_prefix']), self.mqtt_on_ha_status)
+    for host in self.hosts:
+      self.mqtt_client.message_callback_add(self.entity_discovery_topic('+', '+', host), self.mqtt_on_entity_discovery)
+    try:
+      self.mqtt_client.connect_async(self.config['mqtt_broker'], int(self.config['mqtt_port']), 30)
+    except ValueError as e:
+      self.error("MQTT client error: {}".format(str(e)))
+    # The client's network loop runs on its own thread, so nothing else ever
+    # waits on the broker, and it reconnects whenever the connection drops
+    # or can't be made; see mqtt_reconnect()
+    self.mqtt_client.loop_start()
+
+  def mqtt_reconnect(self):
+    # Called whenever the connection drops or can't be made, to set how long
+    # the client waits before trying again: an exponential back-off with
+    # jitter, so that a broker restart isn't met by every client at once.
+    # paho would only double its delay each time, so it is set afresh here
+    delay = min(self.config['mqtt_reconnect_min_delay'] * 2 ** self.mqtt_failures, self.config['mqtt_reconnect_max_delay'])
+    delay = random.uniform(delay / 2, delay)
+    self.mqtt_client.reconnect_delay_set(min_delay=delay, max_delay=delay)
+    self.mqtt_failures += 1
+    self.diagnostics.count('mqtt_reconnects')
+    self.info("Reconnecting to MQTT broker in {:.1f}s ...".format(delay))
 
   def mqtt_on_connect(self, mqtt_client, userdata, flags, rc):
+    if rc != 0:
+      self.info("MQTT broker refused the connection: {}".format(mqtt.connack_string(rc)))
+      return
     self.mqtt_connected = True
+    self.mqtt_failures = 0
     self.info('MQTT broker connected.')
+    self.publish_message(topic=self.status_topic, payload="online", qos=1, retain=True)
+    # Publish every sensor's availability afresh on the new connection
+    self.availability = {}
+    # Discovery is only sent if it has changed since it was last published
+    # (see publish_ha_discovery()), or when Home Assistant comes back online
+    self.mqtt_client.subscribe("{}/status".format(self.config['mqtt_ha_prefix']), qos=1)
+    self.publish_ha_discovery()
+    # Look for per-entity configs left behind from before switching to device discovery
+    if self.config['mqtt_discovery'] == 'device':
+      for host in self.hosts:
+        self.mqtt_client.subscribe(self.entity_discovery_topic('+', '+', host), qos=1)
     if self.ha_registered is False:
-      for sensor in self.sensors:
-        self.publish_ha_discovery(sensor)
       for sensor in self.sensors:
         self.publish_attributes(sensor)
       self.ha_registered = True
+    self.mqtt_ready.set()
+
+  def mqtt_on_ha_status(self, mqtt_client, userdata, message):
+    # Home Assistant's birth message, sent whenever it (re)starts
+    if message.payload == b'online':
+      self.info("Home Assistant is online")
+      self.publish_ha_discovery(force=True)
+
+  def mqtt_on_entity_discovery(self, mqtt_client, userdata, message):
+    # A retained per-entity config found in device discovery mode is migrated
+    # the way Home Assistant asks: the entity is unloaded (but kept in its
+    # registry), the device config is sent again to adopt it, and the old
+    # config is removed
+    if not message.retain or not message.payload or b'migrate_discovery' in message.payload:
+      return
+    self.info("Migrating {} to device discovery".format(message.topic))
+    self.publish_message(topic=message.topic, payload=json.dumps({'migrate_discovery': True}), qos=1, retain=True)
+    # The retained configs all arrive together on subscribing, so the device
+    # configs are sent once, shortly after the first, for all of them
+    with self.migration_lock:
+      self.migrating.add(message.topic)
+      if self.migration is None:
+        self.migration = threading.Timer(1, self.finish_migration)
+        self.migration.daemon = True
+        self.migration.start()
+
+  def finish_migration(self):
+    with self.migration_lock:
+      topics, self.migrating, self.migration = self.migrating, set(), None
+    self.publish_ha_discovery(force=True)
+    for topic in topics:
+      self.publish_message(topic=topic, payload="", qos=1, retain=True)
+
+  def mqtt_on_connect_fail(self, mqtt_client, userdata):
+    self.info("Unable to connect to MQTT broker")
+    self.mqtt_reconnect()
 
   def mqtt_on_disconnect(self, mqtt_client, userdata, rc):
     self.mqtt_connected = False
     self.info('MQTT broker disconnected!')
-    if rc == 0:
-      self.mqtt_connect()
-    else:
-      try:
-        self.retry_or_fail_reconnect()
-      except RetryError:
-        self.error("Reconnecting to MQTT broker failed after multiple attempts.")
-  
-  @retry(stop_max_attempt_number=10, wait_exponential_multiplier=1000, wait_exponential_max=30000, wrap_exception=True)
-  def retry_or_fail_reconnect(self):
-    self.info("Attempting to reconnect to MQTT broker ...")
-    self.mqtt_client.reconnect()
-
-  def mqtt_broker_reachable(self):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(5)
-    try:
-      s.connect((self.config['mqtt_broker'], int(self.config['mqtt_port'])))
-      s.close()
-      return True
-    except socket.error:
-      return False
+    self.mqtt_reconnect()
 
-  def publish_message(self, topic, payload, qos=0, retain=False):
-    if self.mqtt_connected:
-      self.mqtt_client.publish(topic=topic, payload=str(payload), qos=qos, retain=retain)
+  def publish_message(self, topic, payload, qos=0, retain=False, buffer=False):
+    # Buffered messages (readings) go to the outbox while the broker is
+    # unreachable, and keep going there until it has been emptied, so that
+    # they are delivered in order; see replay_outbox()
+    if not isinstance(payload, bytes):
+      payload = str(payload)
+    if buffer and self.outbox is not None and (not self.mqtt_connected or len(self.outbox) > 0):
+      self.outbox.append(topic, payload.decode() if isinstance(payload, bytes) else payload, qos, retain)
+    elif self.mqtt_connected:
+      with self.diagnostics.timer('publish'):
+        self.mqtt_client.publish(topic=topic, payload=payload, qos=qos, retain=retain)
+
+  def replay_outbox(self):
+    # Runs on its own thread: sends buffered messages once connected, in
+    # batches at a limited rate, and keeps the outbox's persistent copy up to date
+    persisted = time.monotonic()
+    while True:
+      time.sleep(self.config['outbox_batch_interval'])
+      if self.mqtt_connected and len(self.outbox) > 0:
+        batch = self.outbox.peek(self.config['outbox_batch_size'])
+        try:
+          # QoS 1 at least, so messages are only dropped from the outbox once delivered
+          deliveries = [self.mqtt_client.publish(topic=topic, payload=payload, qos=max(qos, 1), retain=retain) for topic, payload, qos, retain in batch]
+          for delivery in deliveries:
+            delivery.wait_for_publish(timeout=10)
+        except (RuntimeError, ValueError):
+          continue
+        if all(delivery.is_published() for delivery in deliveries):
+          self.outbox.remove(len(batch))
+          self.info("Replayed {} buffered messages ({} remaining)".format(len(batch), len(self.outbox)))
+      if time.monotonic() - persisted > self.config['outbox_persist_interval']:
+        self.outbox.persist()
+        persisted = time.monotonic()
 
   def init_sensor(self, sensor):
+    # Sensors reading different properties of the same physical device share
+    # one instance of its sensor type, keyed on everything that was used to
+    # construct it
+    sensor['device_key'] = (sensor['host']['unique_id'], sensor['device_type'], sensor['device_address'], json.dumps(sensor['device_options'], sort_keys=True))
+    if sensor['device_key'] in self.devices:
+      self.info("Initialising sensor {name} (type: {module}, shared device)".format(name=sensor['name'], module=sensor['device_type']))
+      sensor['instance'] = self.devices[sensor['device_key']]
+      sensor['plan'].bind(sensor['instance'], sensor['device_property'])
+      return
     self.info("Initialising sensor {name} (type: {module})".format(name=sensor['name'], module=sensor['device_type']))
     SensorClass = getattr(importlib.import_module("sensor_types.{}".format(sensor['device_type'])), sensor['device_type'])
-    sensor['instance'] = SensorClass(addr=sensor['device_address'], config=self.config)
+    # Any device options for the sensor are overlaid on its host's config
+    config = self.config | sensor['host']['config'] | (sensor['device_options'] or {})
+    sensor['instance'] = SensorClass(addr=sensor['device_address'], config=config)
+    self.devices[sensor['device_key']] = sensor['instance']
+    sensor['plan'].bind(sensor['instance'], sensor['device_property'])
+    # Event-driven sensor types report changes as they happen
+    if hasattr(sensor['instance'], 'on_change'):
+      sensor['instance'].on_change = self.trigger_update
+    # As can those that time their own work, e.g. scrapes
+    if hasattr(sensor['instance'], 'diagnostics'):
+      sensor['instance'].diagnostics = self.diagnostics
+
+  def trigger_update(self, instance, properties=None):
+    # Called from a sensor type's own thread: wake the scheduler to read and
+    # publish the sensors of this instance whose properties changed (or all
+    # of them) straight away
+    with self.trigger_lock:
+      self.triggered.update(sensor['id'] for sensor in self.sensors if sensor['instance'] is instance
+                            and (properties is None or sensor['device_property'] in properties))
+    self.wakeup.set()
 
-  def update(self):
+  def read_sensor(self, sensor):
+    started = time.perf_counter()
+    try:
+      # Read the measurement value from the sensor
+      value = sensor['plan'].read()
+      return value, None, time.time()
+    except MeasurementError as error:
+      return None, error, time.time()
+    finally:
+      self.diagnostics.observe("read.{}".format(sensor['id']), time.perf_counter() - started)
+
+  def read_bus(self, sensors, results):
+    # Sensor types with an acquire() method take a single measurement per
+    # cycle, from which all of their properties are then served; the
+    # readings themselves are cached for the cycle too, so a property
+    # shared by several sensors is only read once. Each result is put on
+    # the results queue as soon as it is ready, along with when that was
+    acquired = {}
+    readings = {}
+    for sensor in sensors:
+      instance = sensor['instance']
+      if hasattr(instance, 'acquire') and sensor['device_key'] not in acquired:
+        try:
+          with self.diagnostics.timer("acquire.{}".format(sensor['device_type'])):
+            instance.acquire()
+          acquired[sensor['device_key']] = None
+        except MeasurementError as error:
+          acquired[sensor['device_key']] = error
+      if acquired.get(sensor['device_key']) is not None:
+        results.put((time.monotonic(), (None, acquired[sensor['device_key']], time.time())))
+        continue
+      reading_key = (sensor['device_key'], sensor['device_property'])
+      if reading_key not in readings:
+        readings[reading_key] = self.read_sensor(sensor)
+      results.put((time.monotonic(), readings[reading_key]))
+
+  @staticmethod
+  def bus_key(sensor):
+    bus_id = getattr(sensor['instance'], 'bus_id', None)
+    return bus_id if bus_id is not None else sensor['device_key']
+
+  def read_sensors(self, sensors):
+    # Sensors sharing a physical bus (see the 'bus_id' attribute of the
+    # sensor types), or the same device, are read one after another by a
+    # single worker, so their transactions are never interleaved; everything
+    # else is read in parallel.
+    # A read that takes longer than its sensor's read_timeout fails with a
+    # MeasurementError, as do the reads queued behind it on the same bus,
+    # and that bus is left alone until the hung read returns. Devices that
+    # keep failing are skipped altogether for a while; see update_breakers()
+    now = time.monotonic()
+    results = {}
+    buses = {}
+    for sensor in sensors:
+      breaker = self.breakers.get(sensor['device_key'])
+      if breaker is not None and now < breaker['open_until']:
+        results[sensor['id']] = (None, MeasurementError("Not read for another {:.0f}s after {} failures".format(breaker['open_until'] - now, breaker['failures'])), time.time())
+      else:
+        buses.setdefault(self.bus_key(sensor), []).append(sensor)
+    jobs = []
+    for bus_key, group in buses.items():
+      if bus_key in self.bus_jobs and not self.bus_jobs[bus_key].done():
+        for sensor in group:
+          results[sensor['id']] = (None, MeasurementError("Bus is still busy with a read that timed out"), time.time())
+        continue
+      readings = queue.Queue()
+      self.bus_jobs[bus_key] = self.executor.submit(self.read_bus, group, readings)
+      jobs.append((group, readings, self.bus_jobs[bus_key], time.monotonic()))
+    for group, readings, job, submitted in jobs:
+      # Each read's timeout runs from when the read before it on the bus
+      # finished (or the job was submitted), not from when it is waited on,
+      # so buses that hang together only hold the cycle up once
+      finished = submitted
+      for i, sensor in enumerate(group):
+        try:
+          finished, results[sensor['id']] = readings.get(timeout=max(0, finished + sensor['read_timeout'] - time.monotonic()))
+        except queue.Empty:
+          if job.done():
+            job.result()  # re-raise whatever stopped the worker
+          self.diagnostics.count("read_timeouts.{}".format(sensor['id']))
+          error = MeasurementError("Read timed out after {}s".format(sensor['read_timeout']))
+          for pending in group[i:]:
+            results[pending['id']] = (None, error, time.time())
+          break
+    self.update_breakers(sensors, results)
+    return [results[sensor['id']] for sensor in sensors]
+
+  def update_breakers(self, sensors, results):
+    # A device fails a cycle if none of its sensors could be read. After
+    # breaker_threshold failures in a row it is not read for breaker_backoff
+    # seconds, doubling with each failure after that (up to
+    # breaker_max_backoff), until a read succeeds again
+    succeeded = {}
+    for sensor in sensors:
+      succeeded[sensor['device_key']] = succeeded.get(sensor['device_key'], False) or results[sensor['id']][1] is None
+    now = time.monotonic()
+    for device_key, success in succeeded.items():
+      if success:
+        if self.breakers.pop(device_key, None) is not None:
+          self.info("Device {} has recovered".format(device_key[0]))
+        continue
+      breaker = self.breakers.setdefault(device_key, {'failures': 0, 'open_until': 0})
+      if now < breaker['open_until']:
+        continue  # wasn't read at all
+      breaker['failures'] += 1
+      if breaker['failures'] >= self.config['breaker_threshold']:
+        backoff = min(self.config['breaker_backoff'] * 2 ** (breaker['failures'] - self.config['breaker_threshold']), self.config['breaker_max_backoff'])
+        breaker['open_until'] = now + backoff
+        self.diagnostics.count('breaker_trips')
+        self.info("Device {} failed {} times in a row, backing off for {}s".format(device_key[0], breaker['failures'], backoff))
+
+  def publish_availability(self, sensor, status):
+    # Availability is retained, so it only needs publishing when it changes
+    if self.availability.get(sensor['id']) != status:
+      self.publish_message(topic=sensor['plan'].status_topic, payload=status, qos=1, retain=True)
+      self.availability[sensor['id']] = status
+
+  def adapt_period(self, sensor, value):
+    # Adaptive sampling: while successive readings differ by more than the
+    # sensor's sensitivity, its period is halved (down to update_period_min);
+    # while they differ by less than a quarter of it, the period grows by
+    # half (up to update_period_max). Either way, the next read is
+    # rescheduled to suit
+    if sensor['sensitivity'] is None:
+      return
+    state = self.filters.setdefault(sensor['id'], {})
+    previous = state.get('adapt_value')
+    state['adapt_value'] = value
+    if previous is None:
+      return
+    period = self.periods.get(sensor['id'], sensor['update_period'])
+    change = abs(value - previous)
+    if change > sensor['sensitivity']:
+      adapted = max(period / 2, sensor['update_period_min'])
+    elif change < sensor['sensitivity'] / 4:
+      adapted = min(period * 1.5, sensor['update_period_max'])
+    else:
+      return
+    if adapted != period:
+      self.periods[sensor['id']] = adapted
+      self.schedule_read(sensor, time.monotonic() + adapted)
+      self.info("Sensor {} changed by {:g}, now read every {:.1f}s".format(sensor['name'], change, adapted))
+
+  def aggregate_reading(self, sensor, value):
+    # With aggregate_samples set, samples are collected into a window and only
+    # its aggregate (mean, min or max) is published, once the window is full
+    if sensor['aggregate_samples'] is None:
+      return value
+    window = self.filters.setdefault(sensor['id'], {}).setdefault('window', [])
+    window.append(value)
+    if len(window) < sensor['aggregate_samples']:
+      return None
+    self.filters[sensor['id']]['window'] = []
+    return self.aggregate_functions[sensor['aggregate_function']](window)
+
+  def outside_deadband(self, sensor, value):
+    # A reading is published if it has moved outside any deadband set for the
+    # sensor since the last reading published (for non-numeric readings, if it
+    # has changed at all), or if nothing has been published for max_silence
+    if sensor['deadband'] is None and sensor['deadband_percent'] is None:
+      return True
+    state = self.filters.setdefault(sensor['id'], {})
+    now = time.monotonic()
+    if 'published_value' not in state or now - state['published_time'] >= sensor['max_silence']:
+      changed = True
+    elif value is None or state['published_value'] is None or isinstance(value, (bool, str)):
+      changed = value != state['published_value']
+    else:
+      change = abs(value - state['published_value'])
+      changed = (sensor['deadband'] is not None and change > sensor['deadband']) or \
+                (sensor['deadband_percent'] is not None and change > abs(state['published_value']) * sensor['deadband_percent'] / 100)
+    if changed:
+      state['published_value'] = value
+      state['published_time'] = now
+    return changed
+
+  def update(self, sensors=None):
+      if sensors is None:
+        sensors = self.sensors
       try:
-        for sensor in self.sensors:
-          status_topic = "sensors/{}/status".format(sensor['id'])
-          reading = {}
-          try:
-            # Read the measurement value from the sensor
-            value = getattr(sensor['instance'], sensor['device_property'])
-          except MeasurementError as error:
-            self.publish_message(topic=status_topic, payload="offline")
+        started = time.monotonic()
+        results = self.read_sensors(sensors)
+        self.info("Read {} sensors in {:.3f}s".format(len(sensors), time.monotonic() - started))
+        for sensor, (value, error, sampled) in zip(sensors, results):
+          plan = sensor['plan']
+          if error is not None:
+            self.diagnostics.count("read_errors.{}".format(sensor['id']))
+            self.filters.pop(sensor['id'], None)
+            self.publish_availability(sensor, "offline")
             self.info("Failed to update measurements for sensor {} ({}). Sensor status will be set to offline.".format(sensor['id'], str(error)))
           else:
-            self.publish_message(topic=status_topic, payload="online")
-            reading['timestamp'] = datetime.now().isoformat(timespec='seconds')
+            self.publish_availability(sensor, "online")
             # Apply any offset correction and round value for output
             if value is not None and not isinstance(value, (bool, str)):
-              if sensor['device_offset'] is not None:
-                value += sensor['device_offset']
-              reading['value'] = round(value, sensor['output_precision'])
-            else:
-              reading['value'] = value
-            self.info(" ↪ Sensor {}: {}{}".format(sensor['name'], reading['value'], sensor['units'] if sensor['units'] is not None else ''))
-            self.publish_message(topic="sensors/{}/state".format(sensor['id']), payload=json.dumps(reading))
+              value = plan.correct(value)
+              self.adapt_period(sensor, value)
+              value = self.aggregate_reading(sensor, value)
+              if value is None:
+                continue
+              value = plan.round(value)
+            if not self.outside_deadband(sensor, value):
+              continue
+            if self.config['verbose']:
+              self.info(" ↪ Sensor {}: {}{}".format(sensor['name'], value, sensor['units'] if sensor['units'] is not None else ''))
+            for sink in self.sinks:
+              sink.submit(sensor, value, sampled)
+        if self.unidentified:
+          self.update_attributes(sensors, results)
+        # In aggregate mode, the MQTT sink sends the latest reading of every
+        # sensor in a single message to its host's state topic now
+        for sink in self.sinks:
+          sink.flush()
+        elapsed = time.monotonic() - started
+        self.diagnostics.observe('update', elapsed)
+        if elapsed > self.config['update_period']:
+          self.diagnostics.count('overruns')
       except Exception as e:
         self.error("Error updating sensors: {}".format(str(e)))
 
+  def update_attributes(self, sensors, results):
+    # Attributes published before a device could identify itself are
+    # published again once it has been read successfully and can
+    if not self.mqtt_connected:
+      return
+    for device_key in { sensor['device_key'] for sensor, (_, error, _) in zip(sensors, results) if error is None } & self.unidentified:
+      instance = self.devices[device_key]
+      attr_data = self.device_attributes[device_key]
+      if (instance.serial_number, instance.model, instance.manufacturer) == (attr_data['serial_number'], attr_data['type'], attr_data['manufacturer']):
+        continue
+      del self.device_attributes[device_key]
+      self.unidentified.discard(device_key)
+      for sensor in self.sensors:
+        if sensor['device_key'] == device_key:
+          self.publish_attributes(sensor)
+
   def publish_attributes(self, sensor):
     self.info("Publishing attributes for sensor {}".format(sensor['name']))
-    attr_data = {}
-    attr_data['serial_number']  = sensor['instance'].serial_number
-    attr_data['type']           = sensor['instance'].model
-    attr_data['manufacturer']   = sensor['instance'].manufacturer
-    self.publish_message(topic="sensors/{}/attributes".format(sensor['id']), payload=json.dumps(attr_data, indent=2), qos=1, retain=True)
-
-  def publish_ha_discovery(self, sensor):
-    self.info("Registering sensor {} with Home Assistant".format(sensor['name']))
-    config_topic = "{prefix}/{component}/{node}/{object}/config".format(
-                                                          prefix=self.config['mqtt_ha_prefix'],
-                                                          component=sensor['ha_component_type'],
-                                                          node=self.unique_id,
-                                                          object=sensor['name'])
+    # Attributes are only read from the device once, however many sensors it provides
+    if sensor['device_key'] not in self.device_attributes:
+      attr_data = {}
+      attr_data['serial_number']  = sensor['instance'].serial_number
+      attr_data['type']           = sensor['instance'].model
+      attr_data['manufacturer']   = sensor['instance'].manufacturer
+      self.device_attributes[sensor['device_key']] = attr_data
+      # Some devices can only say what they are once they have been read
+      # (e.g. a host scraped over the network); see update_attributes()
+      if not all(attr_data.values()):
+        self.unidentified.add(sensor['device_key'])
+    attr_data = self.device_attributes[sensor['device_key']]
+    self.publish_message(topic="sensors/{}/attributes".format(sensor['id']), payload=json.dumps(attr_data, separators=(',', ':')), qos=1, retain=True)
+
+  def ha_discovery_config(self, sensor):
     config_data = {}
     config_data['unique_id']              = sensor['id']
-    config_data['state_topic']            = "sensors/{}/state".format(sensor['id'])
-    config_data['availability_topic']     = "sensors/{}/status".format(sensor['id'])
+    if self.config['mqtt_aggregate_state']:
+      config_data['state_topic']          = sensor['host']['state_topic']
+    else:
+      config_data['state_topic']          = sensor['plan'].state_topic
+    # The sensor is available when both it and the device (see the last will set in mqtt_connect()) are
+    config_data['availability']           = [ { 'topic': self.status_topic }, { 'topic': sensor['plan'].status_topic } ]
+    config_data['availability_mode']      = "all"
     config_data['json_attributes_topic']  = "sensors/{}/attributes".format(sensor['id']) # See publish_attributes() above
-    config_data['device']                 = self.device_info
+    config_data['device']                 = sensor['host']['device_info']
     if sensor['ha_device_class'] is not None:
       config_data['device_class']           = sensor['ha_device_class']
     if sensor['ha_icon'] is not None:
@@ -285,50 +970,462 @@ class PiKVMHASensors:
     config_data['object_id']              = "{}".format(sensor['id'])
     if sensor['display_precision'] is not None:
       config_data['suggested_display_precision'] = sensor['display_precision']
-    config_data['value_template']         = "{{{{ value_json.{field} }}}}".format(field='value')
-    config_data['force_update']           = True
+    if self.config['mqtt_aggregate_state']:
+      config_data['value_template']       = "{{{{ value_json['{sensor}'].value }}}}".format(sensor=sensor['name'])
+      # Every aggregate message repeats the readings of the sensors not read in that cycle
+      config_data['force_update']         = False
+    else:
+      config_data['value_template']       = "{{{{ value_json.{field} }}}}".format(field='value')
+      config_data['force_update']         = True
     config_data['expire_after']           = self.config['valid_time']
-    self.publish_message(topic=config_topic, payload=json.dumps(config_data, indent=2), qos=1, retain=True)
+    return config_data
+
+  def diagnostics_snapshot(self):
+    snapshot = self.diagnostics.snapshot()
+    # paho doesn't expose the depth of its queues, so these are read from its internals
+    snapshot['gauges'] = {
+      'mqtt_inflight':    getattr(self.mqtt_client, '_inflight_messages', 0),
+      'mqtt_unacked':     len(getattr(self.mqtt_client, '_out_messages', ())),
+      'mqtt_send_queue':  len(getattr(self.mqtt_client, '_out_packet', ())),
+      'outbox':           len(self.outbox) if self.outbox is not None else 0,
+      **{ "sink_queue.{}".format(sink.name): sink.queued() for sink in self.sinks if sink is not self.mqtt_sink },
+      'memory_rss':       memory.rss_bytes(),
+      'python_heap':      memory.heap_bytes()
+    }
+    return snapshot
+
+  def diagnostics_summary(self, snapshot):
+    timers, counters, gauges = snapshot['timers'], snapshot['counters'], snapshot['gauges']
+    return {
+      'cycle_time_p90':   timers['update']['p90_ms'] if 'update' in timers else None,
+      'slowest_read_p90': max((timer['p90_ms'] for name, timer in timers.items() if name.startswith('read.')), default=None),
+      'read_errors':      sum(count for name, count in counters.items() if name.startswith('read_errors.')),
+      'overruns':         counters.get('overruns', 0),
+      'missed_deadlines': counters.get('missed_deadlines', 0),
+      'mqtt_queue':       gauges['mqtt_unacked'] + gauges['mqtt_send_queue'],
+      'memory_rss':       round(gauges['memory_rss'] / memory.MIB, 1) if gauges['memory_rss'] is not None else None,
+      'python_heap':      round(gauges['python_heap'] / memory.MIB, 1) if gauges['python_heap'] is not None else None
+    }
+
+  def request_dump(self, signum=None, frame=None):
+    # SIGUSR1 handler: the diagnostics are written between cycles, as taking
+    # their lock here could deadlock with the code the signal interrupted
+    self.dump_requested = True
+    self.wakeup.set()
+
+  def dump_diagnostics(self):
+    # Write the full diagnostics out as JSON
+    self.dump_requested = False
+    try:
+      os.makedirs(os.path.dirname(self.config['diagnostics_dump']), exist_ok=True)
+      with open(self.config['diagnostics_dump'], 'w') as f:
+        json.dump(self.diagnostics_snapshot(), f, indent=2)
+      self.info("Diagnostics written to {}".format(self.config['diagnostics_dump']))
+    except IOError as e:
+      self.info("Unable to write diagnostics: {}".format(str(e)))
+
+  def request_memory_report(self, signum=None, frame=None):
+    # SIGUSR2 handler: the report is made between cycles, like the dump
+    self.memory_report_requested = True
+    self.wakeup.set()
+
+  def report_memory(self):
+    # Log where the memory allocated since the last report came from. This
+    # goes to the journal even when not verbose
+    self.memory_report_requested = False
+    rss = memory.rss_bytes() or 0
+    lines = self.memory_tracer.report()
+    if lines is None:
+      print("Tracing memory allocations (RSS {:.1f} MiB); send SIGUSR2 again for what was allocated since".format(rss / memory.MIB))
+      return
+    print("Memory allocated since the last report (RSS {:.1f} MiB, Python heap {:.1f} MiB):\n  {}".format(
+      rss / memory.MIB, memory.heap_bytes() / memory.MIB, "\n  ".join(lines)))
+
+  def check_memory(self):
+    # Past the memory budget, collect garbage and hand freed heap memory back
+    # to the system. That is done again only if memory use keeps growing, as
+    # a full collection every cycle would cost more than it frees
+    budget = self.config['memory_budget']
+    rss = memory.rss_bytes()
+    if budget is None or rss is None:
+      return
+    if rss <= budget * memory.MIB:
+      self.over_budget = False
+      self.memory_trimmed = None
+      return
+    if self.memory_trimmed is not None and rss <= self.memory_trimmed + memory.MIB:
+      return
+    memory.trim()
+    self.diagnostics.count('memory_trims')
+    self.memory_trimmed = memory.rss_bytes()
+    if self.memory_trimmed > budget * memory.MIB and not self.over_budget:
+      self.over_budget = True
+      self.info("Memory use ({:.1f} MiB) is over memory_budget ({} MiB); send SIGUSR2 twice to see where it is allocated".format(
+        self.memory_trimmed / memory.MIB, budget))
+
+  def publish_diagnostics(self):
+    snapshot = self.diagnostics_snapshot()
+    self.publish_message(topic=self.diagnostics_topic, payload=json.dumps(self.diagnostics_summary(snapshot)))
+    self.publish_message(topic="{}/attributes".format(self.diagnostics_topic), payload=json.dumps(snapshot))
+
+  def diagnostics_discovery_configs(self):
+    configs = {}
+    for name, (title, units, device_class, state_class) in self.diagnostic_entities.items():
+      config_data = {}
+      config_data['unique_id']            = "{}_{}".format(self.unique_id, name)
+      config_data['object_id']            = config_data['unique_id']
+      config_data['name']                 = title
+      config_data['state_topic']          = self.diagnostics_topic
+      config_data['value_template']       = "{{{{ value_json.{field} }}}}".format(field=name)
+      config_data['availability_topic']   = self.status_topic
+      config_data['entity_category']      = "diagnostic"
+      config_data['state_class']          = state_class
+      config_data['device']               = self.device_info
+      if units is not None:
+        config_data['unit_of_measurement'] = units
+      if device_class is not None:
+        config_data['device_class']       = device_class
+      # The full snapshot, including every sensor's histogram, hangs off the cycle time
+      if name == 'cycle_time_p90':
+        config_data['json_attributes_topic'] = "{}/attributes".format(self.diagnostics_topic)
+      configs[name] = config_data
+    return configs
+
+  def entity_discovery_topic(self, component, name, host=None):
+    node = (host or self.host)['unique_id']
+    return "{prefix}/{component}/{node}/{object}/config".format(prefix=self.config['mqtt_ha_prefix'], component=component, node=node, object=name)
+
+  def device_discovery_topic(self, host):
+    return "{prefix}/device/{node}/config".format(prefix=self.config['mqtt_ha_prefix'], node=host['unique_id'])
+
+  def abbreviate(self, config):
+    if isinstance(config, list):
+      return [ self.abbreviate(item) for item in config ]
+    if isinstance(config, dict):
+      return { self.discovery_abbreviations.get(key, key): self.abbreviate(value) for key, value in config.items() }
+    return config
+
+  def ha_discovery_messages(self):
+    # Every discovery config, as compact JSON keyed on its topic: either one
+    # per entity, or a single config for each host's device listing its
+    # entities as components, with the device block only included once
+    entities = [(sensor['host'], sensor['ha_component_type'], sensor['name'], self.ha_discovery_config(sensor)) for sensor in self.sensors]
+    if self.config['diagnostic_entities']:
+      entities += [(self.host, 'sensor', name, config_data) for name, config_data in self.diagnostics_discovery_configs().items()]
+    if self.config['mqtt_discovery'] == 'device':
+      # Components published before but gone now (after a reload) are
+      # removed by sending their platform alone
+      components = {
+        host['unique_id']: { unique_id: { 'platform': component } for unique_id, component in self.published_components.get(host['unique_id'], {}).items() }
+        for host in self.hosts
+      }
+      for host, component, name, config_data in entities:
+        del config_data['device']
+        components[host['unique_id']][config_data['unique_id']] = { 'platform': component } | config_data
+      messages = {
+        self.device_discovery_topic(host): self.abbreviate({ 'device': host['device_info'], 'origin': self.origin_info, 'components': components[host['unique_id']] })
+        for host in self.hosts
+      }
+    else:
+      messages = { self.entity_discovery_topic(component, name, host): config_data for host, component, name, config_data in entities }
+    return { topic: json.dumps(config_data, separators=(',', ':')).encode() for topic, config_data in messages.items() }
+
+  def publish_ha_discovery(self, force=False):
+    # A hash of each config last published is kept (in discovery_cache, so
+    # across restarts too), and configs are only sent again if they change,
+    # or if forced when Home Assistant restarts. This is called from the MQTT
+    # client's thread as well as the main one, so only one call at a time
+    # works through the hashes
+    with self.discovery_lock:
+      if not self.mqtt_connected:
+        return
+      messages = self.ha_discovery_messages()
+      changed = False
+      # Configs published before that are no longer wanted (sensors removed by
+      # a reload, or hosts by a restart) are cleared; per-entity configs left
+      # over from before a switch to device discovery are migrated instead,
+      # see mqtt_on_entity_discovery()
+      device_topics = "{}/device/".format(self.config['mqtt_ha_prefix'])
+      for topic in [topic for topic in self.discovery_hashes if topic not in messages]:
+        if self.config['mqtt_discovery'] == 'entity' or topic.startswith(device_topics):
+          self.info("Removing {} from Home Assistant".format(topic))
+          self.publish_message(topic=topic, payload="", qos=1, retain=True)
+        del self.discovery_hashes[topic]
+        changed = True
+      for topic, payload in messages.items():
+        digest = hashlib.sha1(payload).hexdigest()
+        if force or self.discovery_hashes.get(topic) != digest:
+          self.info("Registering {} with Home Assistant".format(topic))
+          self.publish_message(topic=topic, payload=payload, qos=1, retain=True)
+          self.discovery_hashes[topic] = digest
+          changed = True
+      # The components published are kept with the hashes, so that any
+      # removed while the service was stopped are still removed
+      if self.config['mqtt_discovery'] == 'device':
+        components = {}
+        for sensor in self.sensors:
+          components.setdefault(sensor['host']['unique_id'], {})[sensor['id']] = sensor['ha_component_type']
+        if self.config['diagnostic_entities']:
+          components.setdefault(self.unique_id, {}).update({ "{}_{}".format(self.unique_id, name): 'sensor' for name in self.diagnostic_entities })
+        if components != self.published_components:
+          self.published_components = components
+          changed = True
+      if changed:
+        try:
+          if os.path.dirname(self.config['discovery_cache']):
+            os.makedirs(os.path.dirname(self.config['discovery_cache']), exist_ok=True)
+          with open(self.config['discovery_cache'], 'w') as f:
+            json.dump({ 'hashes': self.discovery_hashes, 'components': self.published_components }, f)
+        except IOError:
+          pass
+
+  def terminate(self, signum=None, frame=None):
+    # SIGTERM handler: a normal stop, so the exit status is 0
+    self.info("Terminated")
+    raise SystemExit(0)
+
+  def request_reload(self, signum=None, frame=None):
+    # SIGHUP handler: the reload itself happens between cycles, see start()
+    self.reload_requested = True
+    self.wakeup.set()
+
+  def reload(self):
+    # Re-read both files and apply the differences: only sensors that are new
+    # or have changed are set up again (sharing any device instances that are
+    # still wanted), and removed sensors are taken out of Home Assistant;
+    # everything else keeps its instance, schedule and filter state
+    self.reload_requested = False
+    started = time.monotonic()
+    try:
+      with open(self.config_file, 'r') as yamlconfig:
+        user_config = yaml.safe_load(yamlconfig) or {}
+      with open(self.sensors_file, 'r') as yamlsensors:
+        sensors = yaml.safe_load(yamlsensors) or []
+    except (IOError, yaml.YAMLError) as e:
+      self.info("Reload failed, keeping the current configuration: {}".format(str(e)))
+      return
+    config = { **self.default_config, **user_config }
+    restart = [key for key in self.restart_config if config[key] != self.config[key]]
+    if restart:
+      self.info("Changes to {} will take effect when the service is restarted".format(", ".join(restart)))
+      config |= { key: self.config[key] for key in restart }
+    # The fleet itself only changes on a restart, but its hosts' sensors files are read again
+    fleet, errors = self.build_fleet(config)
+    sensors = self.build_sensors(config, sensors, self.host)
+    for host, host_sensors in fleet:
+      sensors += self.build_sensors(config, host_sensors, host)
+    errors += self.validate_config(config, sensors)
+    if errors:
+      self.info("Reload failed, keeping the current configuration:\n  {}".format("\n  ".join(errors)))
+      return
+    # A sensor is unchanged if everything it was loaded from is the same
+    definition = lambda sensor: { key: sensor[key] for key in self.sensor_template if key not in ('host', 'instance', 'plan', 'device_key') }
+    current = { sensor['id']: sensor for sensor in self.sensors }
+    kept, added = [], []
+    for index, sensor in enumerate(sensors):
+      if sensor['id'] in current and definition(current[sensor['id']]) == definition(sensor):
+        sensors[index] = current[sensor['id']]
+        kept.append(sensors[index])
+      else:
+        added.append(sensor)
+    ids = { sensor['id'] for sensor in sensors }
+    kept_ids = { id(sensor) for sensor in kept }
+    removed = [sensor for sensor in current.values() if id(sensor) not in kept_ids]
+    # New sensors are set up with the new configuration, but if any of them
+    # can't be, nothing changes
+    previous_config, previous_devices = self.config, dict(self.devices)
+    self.config = config
+    try:
+      for sensor in added:
+        self.init_sensor(sensor)
+    except Exception as e:
+      for device_key in [device_key for device_key in self.devices if device_key not in previous_devices]:
+        self.close_device(device_key)
+      self.config = previous_config
+      self.info("Reload failed, keeping the current configuration:\n  Sensor {}: {}".format(sensor['name'], str(e) or type(e).__name__))
+      return
+    self.mqtt_sink.aggregate = config['mqtt_aggregate_state']
+    self.sensors = sensors
+    # Device instances no one uses any more are let go
+    wanted = { sensor['device_key'] for sensor in self.sensors }
+    for device_key in [device_key for device_key in self.devices if device_key not in wanted]:
+      self.close_device(device_key)
+    for sensor in removed:
+      self.filters.pop(sensor['id'], None)
+      self.availability.pop(sensor['id'], None)
+      self.missed_deadlines.pop(sensor['id'], None)
+      self.periods.pop(sensor['id'], None)
+      if sensor['id'] not in ids:
+        self.mqtt_sink.forget(sensor)
+        self.diagnostics.discard([metric.format(sensor['id']) for metric in ('read.{}', 'read_errors.{}', 'read_timeouts.{}')])
+        self.publish_message(topic=sensor['plan'].status_topic, payload="", qos=1, retain=True)
+        self.publish_message(topic="sensors/{}/attributes".format(sensor['id']), payload="", qos=1, retain=True)
+    self.schedule = [entry for entry in self.schedule if id(entry[2]) in kept_ids]
+    heapq.heapify(self.schedule)
+    # Switching reads between spread out and not moves every sensor's phase
+    if self.spread_reads(config) != self.spread_reads(previous_config):
+      self.schedule_sensors()
+    else:
+      self.schedule_sensors(added)
+    self.publish_ha_discovery()
+    for sensor in added:
+      if self.mqtt_connected:
+        self.publish_attributes(sensor)
+    self.info("Reloaded in {:.0f}ms: {} sensors unchanged, {} added or changed, {} removed".format(
+      (time.monotonic() - started) * 1000, len(kept), len(added), len([sensor for sensor in removed if sensor['id'] not in ids])))
+
+  def close_device(self, device_key):
+    # Stop any threads of the sensor type's own, e.g. kvmd's event stream
+    instance = self.devices.pop(device_key)
+    self.device_attributes.pop(device_key, None)
+    self.unidentified.discard(device_key)
+    if hasattr(instance, 'close'):
+      instance.close()
+
+  def schedule_sensors(self, sensors=None):
+    # Each sensor is polled on its own period, measured against the monotonic
+    # clock. Unless a sensor sets its own phase, sensors are offset across the
+    # period one bus at a time (see read_sensors()), so the reads on different
+    # buses are spread out over the period rather than all landing together
+    # (see spread_reads())
+    if sensors is None:
+      sensors = self.sensors
+    now = time.monotonic()
+    buses = []
+    for sensor in self.sensors:
+      bus_key = self.bus_key(sensor)
+      if bus_key not in buses:
+        buses.append(bus_key)
+      sensor['bus_slot'] = buses.index(bus_key)
+    for sensor in sensors:
+      phase = sensor['update_phase']
+      if phase is None:
+        phase = self.config['update_period'] * sensor['bus_slot'] / len(buses) % sensor['update_period'] if self.spread_reads(self.config) else 0
+      self.missed_deadlines[sensor['id']] = 0
+      self.schedule_read(sensor, now + phase)
+
+  def spread_reads(self, config):
+    # In aggregate mode, reads are not spread: each update() sends its
+    # host's whole state, so spreading would send it once per bus instead
+    # of once per period
+    return config['spread_reads'] and not config['mqtt_aggregate_state']
+
+  def schedule_read(self, sensor, deadline):
+    # Only a sensor's latest entry in the schedule counts: any earlier one
+    # (from before its period adapted) is dropped when it comes up
+    sensor['schedule_seq'] = next(self.schedule_seq)
+    heapq.heappush(self.schedule, (deadline, sensor['schedule_seq'], sensor))
+
+  def due_sensors(self):
+    # Wait for the earliest deadline (or an event-driven update), then
+    # collect every sensor that is due
+    delay = self.schedule[0][0] - time.monotonic() if self.schedule else None
+    if delay is None or delay > 0:
+      self.wakeup.wait(delay)
+    self.wakeup.clear()
+    with self.trigger_lock:
+      triggered, self.triggered = self.triggered, set()
+    now = time.monotonic()
+    due = []
+    while self.schedule and self.schedule[0][0] <= now:
+      deadline, seq, sensor = heapq.heappop(self.schedule)
+      if seq != sensor['schedule_seq']:
+        continue
+      due.append(sensor)
+      # Deadlines advance by whole periods from the previous deadline, not
+      # from when the read happened, so the schedule doesn't drift; any
+      # periods that have already gone by are skipped and counted as missed
+      period = self.periods.get(sensor['id'], sensor['update_period'])
+      missed = int((now - deadline) // period)
+      if missed > 0:
+        self.missed_deadlines[sensor['id']] += missed
+        self.diagnostics.count('missed_deadlines', missed)
+        self.info("Sensor {} missed {} deadline(s) ({} in total)".format(sensor['name'], missed, self.missed_deadlines[sensor['id']]))
+      self.schedule_read(sensor, deadline + (missed + 1) * period)
+    triggered -= {sensor['id'] for sensor in due}
+    due += [sensor for sensor in self.sensors if sensor['id'] in triggered]
+    return due
 
   def start(self):
     for sensor in self.sensors:
       self.init_sensor(sensor)
     self.mqtt_connect()
-    time.sleep(2)
-    while True:
-      self.info("Timestamp: {}".format(datetime.now().isoformat(timespec='seconds')))
-      self.update()
-      time.sleep(self.config['update_period'])
+    # Readings start either way: until the broker is reached they go to the
+    # outbox (if there is one), and discovery is sent once it connects
+    if not self.mqtt_ready.wait(timeout=self.config['mqtt_connect_timeout']):
+      self.info("Timed out waiting for the MQTT broker to accept the connection; starting anyway")
+    startup_time = get_process_age()
+    self.info("Started in {:.2f}s".format(startup_time))
+    sd_notify("READY=1\nSTATUS=Started in {:.2f}s".format(startup_time))
+    self.schedule_sensors()
+    if self.outbox is not None:
+      threading.Thread(target=self.replay_outbox, daemon=True).start()
+    # Exit through SystemExit on SIGTERM, so the outbox is persisted below
+    signal.signal(signal.SIGTERM, self.terminate)
+    signal.signal(signal.SIGUSR1, self.request_dump)
+    signal.signal(signal.SIGUSR2, self.request_memory_report)
+    if self.config_file is not None and self.sensors_file is not None:
+      signal.signal(signal.SIGHUP, self.request_reload)
+    diagnostics_due = time.monotonic() + self.config['diagnostics_period']
+    try:
+      while True:
+        due = self.due_sensors()
+        if self.reload_requested:
+          self.reload()
+          current = { id(sensor) for sensor in self.sensors }
+          due = [sensor for sensor in due if id(sensor) in current]
+        if self.dump_requested:
+          self.dump_diagnostics()
+        if self.memory_report_requested:
+          self.report_memory()
+        self.info("Timestamp: {}".format(datetime.now().isoformat(timespec='seconds')))
+        self.update(due)
+        self.check_memory()
+        if self.config['diagnostic_entities'] and time.monotonic() >= diagnostics_due:
+          self.publish_diagnostics()
+          diagnostics_due = time.monotonic() + self.config['diagnostics_period']
+    finally:
+      for sink in self.sinks:
+        sink.close()
+      if self.outbox is not None:
+        self.outbox.persist()
 
 
 def main(args):
   config = {}
   if len(args) > 0:
-    file = args[0]
+    config_file = args[0]
   else:
-    file = "config.yaml"
+    config_file = "config.yaml"
   try:
-    with open(file, 'r') as yamlconfig:
+    with open(config_file, 'r') as yamlconfig:
       config = yaml.safe_load(yamlconfig)
   except (IOError, yaml.YAMLError) as e:
     sys.exit("ERROR: {}".format(str(e)))
 
   sensors = []
   if len(args) > 1:
-    file = args[1]
+    sensors_file = args[1]
   else:
-    file = "sensors.yaml"
+    sensors_file = "sensors.yaml"
   try:
-    with open(file, 'r') as yamlsensors:
+    with open(sensors_file, 'r') as yamlsensors:
       sensors = yaml.safe_load(yamlsensors)
   except (IOError, yaml.YAMLError) as e:
     sys.exit("ERROR: {}".format(str(e)))
   
   try:
-    pikvmha = PiKVMHASensors(config, sensors)
+    pikvmha = PiKVMHASensors(config, sensors, config_file=config_file, sensors_file=sensors_file)
     pikvmha.start()
   except (KeyboardInterrupt, SystemExit) as e:
-    sys.exit("ERROR: {}".format(str(e)))
+    status = 0 if isinstance(e, SystemExit) and e.code == 0 else 1
+    if status != 0:
+      print("ERROR: {}".format(str(e)), file=sys.stderr)
+  # Exit without waiting for the reader threads, as one stuck in a hung
+  # read would keep the process alive until systemd killed it
+  sys.stdout.flush()
+  sys.stderr.flush()
+  os._exit(status)
 
 if __name__ == "__main__":
   main(sys.argv[1:])
@@ -1,3 +1,4 @@
+import os, time, threading
 from typing import Optional
 from datetime import datetime
 from w1thermsensor import W1ThermSensor, Sensor
@@ -9,17 +10,88 @@ class ds18b20():
   manufacturer = 'MAXIM'
   model = 'DS18B20'
 
+  # A bulk conversion is shared by all probes on a bus master for at most this long
+  conversion_max_age_seconds = 5
+  _bulk_conversions = {}
+  _bulk_conversions_lock = threading.Lock()
+
   def __init__(self, addr: Optional[str] = None, config: Optional[dict] = None):
+    config = config or {}
     self._w1therm = W1ThermSensor(sensor_type=Sensor.DS18B20, sensor_id=addr)
     self._id = addr
+    self._slave_dir = os.path.realpath(self._w1therm.sensorpath.parent)
+    self._master_dir = os.path.dirname(self._slave_dir)
+    # All probes wired to the same 1-wire master share its bus
+    self.bus_id = "w1:{}".format(os.path.basename(self._master_dir))
+    if config.get('resolution') is not None:
+      self.resolution = config['resolution']
+    # Bulk conversion needs the 'therm_bulk_read' and 'temperature'
+    # sysfs attributes of the w1_therm driver (Linux 5.9 onwards)
+    self._bulk_read = config.get('bulk_read', True) \
+                      and os.path.exists(os.path.join(self._master_dir, 'therm_bulk_read')) \
+                      and os.path.exists(os.path.join(self._slave_dir, 'temperature'))
+    self._generation = 0
 
   @property
   def temperature(self):
+    if self._bulk_read:
+      return self._bulk_temperature()
     try:
       return self._w1therm.get_temperature()
     except (NoSensorFoundError, SensorNotReadyError, ResetValueError) as error:
       raise MeasurementError(str(error))
 
+  def _bulk_temperature(self):
+    # Rather than each probe running its own conversion, one conversion is
+    # started on every probe on the bus at once. Each probe then reads its
+    # result from that conversion. A new conversion is started only when this
+    # probe has already consumed the latest one, or when it has gone stale
+    with self._bulk_conversions_lock:
+      bus = self._bulk_conversions.setdefault(self._master_dir, {
+        'lock':       threading.Lock(),
+        'generation': 0,
+        'timestamp':  0.0
+      })
+    try:
+      with bus['lock']:
+        if self._generation == bus['generation'] or \
+           time.monotonic() - bus['timestamp'] > self.conversion_max_age_seconds:
+          with open(os.path.join(self._master_dir, 'therm_bulk_read'), 'w') as f:
+            f.write('trigger\n')
+          bus['generation'] += 1
+          bus['timestamp'] = time.monotonic()
+        self._generation = bus['generation']
+        # The driver blocks this read until the conversion has completed
+        with open(os.path.join(self._slave_dir, 'temperature'), 'r') as f:
+          temperature = int(f.read()) / 1000
+    except (OSError, ValueError) as error:
+      raise MeasurementError(str(error))
+    if temperature == W1ThermSensor.SENSOR_RESET_VALUE:
+      raise MeasurementError("Sensor {} returned its power-on reset value".format(self._id))
+    return temperature
+
+  @property
+  def resolution(self):
+    """The conversion resolution of the probe, in bits (9-12)."""
+    try:
+      with open(os.path.join(self._slave_dir, 'resolution'), 'r') as f:
+        return int(f.read())
+    except (OSError, ValueError):
+      return self._w1therm.get_resolution()
+
+  @resolution.setter
+  def resolution(self, bits: int):
+    # Each bit less halves the conversion time, from 750 ms at 12 bits (0.0625°C)
+    # down to 94 ms at 9 bits (0.5°C). The setting is not persisted to EEPROM.
+    if not 9 <= bits <= 12:
+      raise ValueError("DS18B20 resolution must be between 9 and 12 bits, not {}".format(bits))
+    resolution_file = os.path.join(self._slave_dir, 'resolution')
+    if os.path.exists(resolution_file):
+      with open(resolution_file, 'w') as f:
+        f.write("{}\n".format(bits))
+    else:
+      self._w1therm.set_resolution(bits)
+
   @property
   def serial_number(self):
     """The hardware identifier (serial number) for the device."""
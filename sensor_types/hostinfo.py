@@ -1,6 +1,5 @@
 import time, requests
 from typing import Optional
-from datetime import datetime
 from prometheus_client import parser
 from .measurementerror import MeasurementError
 
@@ -10,40 +9,89 @@ class hostinfo():
   model = ''
   url = ''
   metrics_cache_expiry_seconds = 5
+  # Only these metric families are kept from the node_exporter output
+  metric_families = ('node_dmi_info', 'node_hwmon_fan_rpm', 'node_hwmon_temp_celsius')
+  # Connections are kept alive to this many endpoints at once (e.g. a fleet
+  # of hosts), and to each of them by up to this many concurrent scrapes
+  pool_hosts = 64
+  pool_connections_per_host = 2
   _metrics_cache = {}
+  _session = None
+  # Set by the application to record how long scrapes take
+  diagnostics = None
 
   def __init__(self, config, addr: Optional[str] = None):
     self.url = config['prometheus_url']
-    self.read_prom_metrics()
-    dmi_family = self.metrics['node_dmi_info']
-    dmi_labels = dmi_family.samples[0].labels
-    self.manufacturer = dmi_labels['system_vendor']
-    self.model = dmi_labels['board_name']
+    # Reads of this endpoint's sensors are given up on at their read_timeout
+    # anyway, so the scrape needn't outlast it
+    self.timeout = config.get('read_timeout', 10)
+    # Serialise reads against the same endpoint, so that one of them
+    # refreshes the metrics cache and the others are served from it
+    self.bus_id = "http:{}".format(self.url)
+    # The host isn't scraped until it is first read, so that one that is
+    # down doesn't stop the service starting; its manufacturer and model
+    # are filled in from the first successful scrape
 
-  def read_prom_metrics(self):
-    try:
-      if self.url not in self._metrics_cache:
-        self._metrics_cache[self.url] = {
-          'timestamp': datetime.fromisoformat("2023-01-01T00:00"),
-          'data': {}
-        }
-      
-      cache = self._metrics_cache[self.url]
-      
-      if (datetime.now() - cache['timestamp']).total_seconds() > self.metrics_cache_expiry_seconds:
-        response = requests.get(self.url, timeout=10)
+  @property
+  def session(self):
+    # One keep-alive session for every endpoint, shared by all instances
+    if hostinfo._session is None:
+      session = requests.Session()
+      session.headers.update({'Accept-Encoding': 'gzip'})
+      adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_hosts, pool_maxsize=self.pool_connections_per_host)
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      hostinfo._session = session
+    return hostinfo._session
+
+  def acquire(self):
+    """Scrape the endpoint once for all of the readings in this cycle."""
+    self.read_prom_metrics(force=True)
+
+  def read_prom_metrics(self, force: bool = False):
+    if self.url not in self._metrics_cache:
+      self._metrics_cache[self.url] = {
+        'timestamp': None,
+        'index':     {},
+        'dmi_info':  {}
+      }
+
+    cache = self._metrics_cache[self.url]
+
+    if force or cache['timestamp'] is None or time.monotonic() - cache['timestamp'] > self.metrics_cache_expiry_seconds:
+      # Filter the exposition text line by line before it is parsed, so that
+      # only the handful of families we need are ever turned into objects
+      prefixes = tuple(
+        prefix.format(family).encode()
+        for family in self.metric_families
+        for prefix in ("{} ", "{}{{", "# HELP {} ", "# TYPE {} ")
+      )
+      started = time.perf_counter()
+      try:
+        response = self.session.get(self.url, timeout=self.timeout, stream=True)
         response.raise_for_status()
-        parsed_metrics = {
-            family.name: family 
-            for family in parser.text_string_to_metric_families(response.text)
-        }
-        cache['data'] = parsed_metrics
-        cache['timestamp'] = datetime.now()
-      
-      self.metrics = cache['data']
-
-    except (requests.RequestException, StopIteration) as error:
-      raise MeasurementError(str(error))
+        text = "\n".join(line.decode() for line in response.iter_lines() if line.startswith(prefixes)) + "\n"
+        index = {}
+        dmi_info = {}
+        for family in parser.text_string_to_metric_families(text):
+          for sample in family.samples:
+            if family.name == 'node_dmi_info':
+              dmi_info = sample.labels
+            else:
+              index[(family.name, sample.labels.get('chip'), sample.labels.get('sensor'))] = sample.value
+      except (requests.RequestException, ValueError) as error:
+        raise MeasurementError(str(error))
+      finally:
+        if self.diagnostics is not None:
+          self.diagnostics.observe('read_prom_metrics', time.perf_counter() - started)
+      cache['index'] = index
+      cache['dmi_info'] = dmi_info
+      cache['timestamp'] = time.monotonic()
+
+    self.metrics = cache['index']
+    if not self.manufacturer and not self.model and cache['dmi_info']:
+      self.manufacturer = cache['dmi_info'].get('system_vendor', '')
+      self.model = cache['dmi_info'].get('board_name', '')
 
   @property
   def cpu_fan_speed(self):
@@ -98,15 +146,10 @@ class hostinfo():
 
   def _get_metric_value(self, sensor, chip, metric):
     self.read_prom_metrics()
-    if metric not in self.metrics:
-        raise MeasurementError(f"Metric {metric} not found")
-        
-    family = self.metrics[metric]
-    for sample in family.samples:
-        if sample.labels.get('chip') == chip and sample.labels.get('sensor') == sensor:
-            return sample.value
-            
-    raise MeasurementError(f"Metric {metric} with chip={chip} sensor={sensor} not found")
+    try:
+      return self.metrics[(metric, chip, sensor)]
+    except KeyError:
+      raise MeasurementError(f"Metric {metric} with chip={chip} sensor={sensor} not found")
 
   @property
   def serial_number(self):
@@ -1,15 +1,35 @@
+import time, struct
 from typing import Optional
 from datetime import datetime
-from busio import I2C
-from board import SCL, SDA
 import adafruit_htu21d
+from adafruit_htu21d import HUMIDITY, TEMPERATURE
 from .measurementerror import MeasurementError
 
 I2C_ADDRESS = 0x40
 _ID1_CMD = bytearray([0xFA, 0x0F])
 _ID2_CMD = bytearray([0xFC, 0xC9])
+_READ_USER1 = 0xE7
+_WRITE_USER1 = 0xE6
 
-bus = I2C(SCL, SDA)
+# Maximum conversion times in seconds (temperature, humidity) for each
+# resolution setting of the user register, from the HTU21D datasheet:
+#   0: 14-bit T, 12-bit RH   1: 12-bit T, 8-bit RH
+#   2: 13-bit T, 10-bit RH   3: 11-bit T, 11-bit RH
+_CONVERSION_TIMES = ((0.050, 0.016), (0.013, 0.003), (0.025, 0.005), (0.007, 0.008))
+_RESOLUTION_BITS = (0x00, 0x01, 0x80, 0x81)
+_READ_ATTEMPTS = 10
+
+# The I2C bus is only opened (and Blinka's board detection run) when the
+# first htu21d is created, not when this module is imported
+bus = None
+
+def default_bus():
+  global bus
+  if bus is None:
+    from busio import I2C
+    from board import SCL, SDA
+    bus = I2C(SCL, SDA)
+  return bus
 
 def _convert_to_integer(bytes_to_convert):
     """Use bitwise operators to convert the bytes into integers."""
@@ -28,15 +48,95 @@ class htu21d(adafruit_htu21d.HTU21D):
   manufacturer = 'Measurement Specialities'
   model = 'HTU21D'
 
-  def __init__(self, i2c_dev=bus, addr=I2C_ADDRESS, config: Optional[dict] = None):
+  def __init__(self, i2c_dev=None, addr=I2C_ADDRESS, config: Optional[dict] = None):
+    if i2c_dev is None:
+      i2c_dev = default_bus()
     super().__init__(i2c_bus=i2c_dev, address=addr)
+    self.bus_id = "i2c:{}".format(id(i2c_dev))
+    self._reading = None
+    self._serial_number = None
+    if config is not None and config.get('resolution') is not None:
+      self.resolution = config['resolution']
+    self._conversion_times = _CONVERSION_TIMES[self.resolution]
+
+  @property
+  def resolution(self):
+    """The measurement resolution setting (0-3, see _CONVERSION_TIMES)."""
+    buffer = bytearray(1)
+    with self.i2c_device as i2c:
+      i2c.write_then_readinto(bytes([_READ_USER1]), buffer)
+    return _RESOLUTION_BITS.index(buffer[0] & 0x81)
+
+  @resolution.setter
+  def resolution(self, value: int):
+    if value not in range(len(_RESOLUTION_BITS)):
+      raise ValueError("HTU21D resolution must be between 0 and 3, not {}".format(value))
+    buffer = bytearray(1)
+    with self.i2c_device as i2c:
+      i2c.write_then_readinto(bytes([_READ_USER1]), buffer)
+      i2c.write(bytes([_WRITE_USER1, (buffer[0] & ~0x81 & 0xFF) | _RESOLUTION_BITS[value]]))
+    self._conversion_times = _CONVERSION_TIMES[value]
+
+  def _convert(self, command, conversion_time):
+    # In no-hold-master mode the chip lets go of the bus while it converts,
+    # so rather than polling it (as the super class does) the worker sleeps
+    # through the conversion, leaving the CPU free to service other buses
+    self._command(command)
+    time.sleep(conversion_time)
+    data = bytearray(3)
+    for _ in range(_READ_ATTEMPTS):
+      try:
+        with self.i2c_device as i2c:
+          i2c.readinto(data)
+        if data[0] != 0xFF:
+          break
+      except OSError:
+        pass
+      time.sleep(conversion_time / _READ_ATTEMPTS)
+    else:
+      raise MeasurementError("Timed out waiting for HTU21D conversion")
+    value, checksum = struct.unpack(">HB", data)
+    if checksum != adafruit_htu21d._crc(data[:2]):
+      raise MeasurementError("HTU21D CRC mismatch")
+    # The two least significant bits are status bits, not part of the value
+    return value & 0xFFFC
+
+  def acquire(self):
+    """Measure temperature and humidity once for all of the readings in this cycle."""
+    # The chip only runs one conversion at a time, so the two are started
+    # back to back and both results collected in the same pass
+    try:
+      temperature = self._convert(TEMPERATURE, self._conversion_times[0])
+      humidity = self._convert(HUMIDITY, self._conversion_times[1])
+    except (OSError, RuntimeError, MeasurementError) as error:
+      self._reading = None
+      raise MeasurementError(str(error))
+    self._reading = {
+      'temperature':       temperature * 175.72 / 65536.0 - 46.85,
+      'relative_humidity': humidity * 125.0 / 65536.0 - 6.0
+    }
+
+  # N.B. 'temperature' and 'relative_humidity' are measured by the super
+  # class, and served from the last acquire() when there is one
+
+  @property
+  def temperature(self):
+    if self._reading is None:
+      return super().temperature
+    return self._reading['temperature']
+
+  @property
+  def relative_humidity(self):
+    if self._reading is None:
+      return super().relative_humidity
+    return self._reading['relative_humidity']
 
-  # N.B. 'temperature' and 'relative_humidity' properties
-  # are provided by the super class
-  
   @property
   def serial_number(self):
     """The hardware identifier (serial number) for the device."""
+    # The serial number never changes, so the chip is only asked for it once
+    if self._serial_number is not None:
+      return self._serial_number
     # The registers and format of the serial number is the same as for Si7021
     # See also: getSerialNumber() from https://www.espruino.com/modules/HTU21D.js
     try:
@@ -55,6 +155,7 @@ class htu21d(adafruit_htu21d.HTU21D):
         raise RuntimeError("Invalid serial number")
       # The unique serial number part is formed from the remaining bytes
       serial = (id1[2] << 24) | (id1[4] << 16) | (id1[6] << 8) | id2[1]
-      return str(serial)
+      self._serial_number = str(serial)
+      return self._serial_number
     except Exception as e:
       return "Unknown"
@@ -1,42 +1,276 @@
+import os, json, socket, asyncio, threading, copy
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
 from urllib3.exceptions import InsecureRequestWarning
 from typing import Optional, Required
 from .measurementerror import MeasurementError
+from . import rpi
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
+KVMD_API_URL = "http://localhost/api"
+KVMD_EVENTS_URL = "wss://localhost/api/ws?stream=0"
+KVMD_SOCKET = "/run/kvmd/kvmd.sock"
+KVMD_EVENTS_RETRY_SECONDS = 5
+
+
+def _merge_state(state, update):
+  """Apply a (possibly partial) state update from kvmd to a state dict."""
+  for key, value in update.items():
+    if isinstance(value, dict) and isinstance(state.get(key), dict):
+      _merge_state(state[key], value)
+    else:
+      state[key] = value
+  return state
+
+
+def _lookup(state, keys):
+  """The value at keys in a state dict, or None if it isn't there."""
+  for key in keys:
+    if not isinstance(state, dict):
+      return None
+    state = state.get(key)
+  return state
+
+
+class _UnixConnection(HTTPConnection):
+  """An HTTP connection to a server listening on a unix socket."""
+
+  def __init__(self, *args, socket_path, **kwargs):
+    self.socket_path = socket_path
+    super().__init__(*args, **kwargs)
+
+  def _new_conn(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(self.timeout if isinstance(self.timeout, (int, float)) else None)
+    try:
+      sock.connect(self.socket_path)
+    except OSError:
+      sock.close()
+      raise
+    return sock
+
+
+class _UnixConnectionPool(HTTPConnectionPool):
+  ConnectionCls = _UnixConnection
+
+
+class _UnixAdapter(HTTPAdapter):
+  """Sends every request made through a session to the same unix socket, over kept-alive connections."""
+
+  def __init__(self, socket_path, **kwargs):
+    super().__init__(**kwargs)
+    self.pool = _UnixConnectionPool('localhost', maxsize=self._pool_maxsize, socket_path=socket_path)
+
+  def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+    return self.pool
+
+  def get_connection(self, url, proxies=None):
+    return self.pool
+
+  def close(self):
+    self.pool.close()
+    super().close()
+
+
 class kvmd():
 
   manufacturer = 'pikvm.org'
   model = 'PiKVM'
+  components = ('atx', 'hid', 'msd', 'streamer')
+  # Where in kvmd's state each property is read from: the component, then
+  # the keys down to the value
+  fields = {
+    'atx_power':        ('atx', 'leds', 'power'),
+    'atx_hdd_led':      ('atx', 'leds', 'hdd'),
+    'streamer_fps':     ('streamer', 'streamer', 'source', 'captured_fps'),
+    'streamer_clients': ('streamer', 'streamer', 'stream', 'clients'),
+    'msd_connected':    ('msd', 'drive', 'connected'),
+    'hid_online':       ('hid', 'online'),
+  }
+  # The properties whose changes are reported as they happen. The others
+  # (the frame rate, which jitters constantly) are left to be read on their
+  # sensors' update_period
+  evented = ('atx_power', 'atx_hdd_led', 'streamer_clients', 'msd_connected', 'hid_online')
+  _sessions = {}
 
   def __init__(self, config: Required[dict], addr: Optional[str] = None):
     self.config = config
+    # Talk to kvmd directly on its unix socket where it can be reached,
+    # rather than through nginx (TLS, a new connection per request)
+    socket_path = config.get('kvmd_socket', KVMD_SOCKET)
+    self.socket_path = socket_path if socket_path and os.path.exists(socket_path) else None
+    self.url = "http://localhost" if self.socket_path else KVMD_API_URL
+    self.headers = {
+      "X-KVMD-User":   config['pikvm_username'],
+      "X-KVMD-Passwd": config['pikvm_password']
+    }
+    # Serialise reads through the same session
+    self.bus_id = "kvmd:{}".format(self.socket_path or self.url)
+    # Called with this instance and the names of the properties whose values
+    # changed whenever kvmd pushes a change of state
+    self.on_change = None
+    self._state = {}
+    self._state_lock = threading.Lock()
+    self._streaming = False
+    # Component states fetched by acquire() for the current cycle, and the
+    # components the properties read, so that only those are fetched
+    self._polled = {}
+    self._wanted = set()
+    # The event stream's loop and task, for close() to stop it from another thread
+    self._closed = False
+    self._events = None
+    if config.get('kvmd_events', False):
+      threading.Thread(target=self._follow_events, name='kvmd-events', daemon=True).start()
 
   @property
-  def atx_power(self):
-    """The state of power applied to the host."""
+  def session(self):
+    # One keep-alive session per socket (or URL), shared by every instance
+    if self.bus_id not in self._sessions:
+      session = requests.Session()
+      session.headers.update(self.headers)
+      if self.socket_path:
+        session.mount("http://localhost/", _UnixAdapter(self.socket_path, pool_maxsize=1))
+      self._sessions[self.bus_id] = session
+    return self._sessions[self.bus_id]
+
+  def _follow_events(self):
+    try:
+      asyncio.run(self._stream_events())
+    except asyncio.CancelledError:
+      # Stopped by close()
+      pass
+
+  async def _stream_events(self):
+    # aiohttp comes with kvmd, so is only needed when events are enabled
+    import aiohttp
+    self._events = (asyncio.get_running_loop(), asyncio.current_task())
+    while not self._closed:
+      try:
+        # stream=0 asks kvmd for state events only, not the video frames
+        if self.socket_path:
+          connector, url = aiohttp.UnixConnector(path=self.socket_path), "http://localhost/ws?stream=0"
+        else:
+          connector, url = None, KVMD_EVENTS_URL
+        async with aiohttp.ClientSession(headers=self.headers, connector=connector) as session:
+          async with session.ws_connect(url, ssl=False, heartbeat=15) as ws:
+            async for message in ws:
+              if message.type != aiohttp.WSMsgType.TEXT:
+                break
+              self._handle_event(json.loads(message.data))
+      except Exception:
+        # Whatever went wrong, readings go back to polling until reconnected
+        pass
+      finally:
+        with self._state_lock:
+          self._streaming = False
+          self._state = {}
+      await asyncio.sleep(KVMD_EVENTS_RETRY_SECONDS)
+
+  def close(self):
+    """Stop following kvmd's events, once this instance is no longer used."""
+    self._closed = True
+    self.on_change = None
+    if self._events is not None:
+      loop, task = self._events
+      try:
+        loop.call_soon_threadsafe(task.cancel)
+      except RuntimeError:
+        # The loop has already finished
+        pass
+
+  def _handle_event(self, message):
+    # Older kvmd releases name the events e.g. 'atx_state', newer ones just 'atx'
+    if not isinstance(message, dict) or not isinstance(message.get('event_type'), str):
+      return
+    component = message['event_type'].removesuffix('_state')
+    if component not in self.components or not isinstance(message.get('event'), dict):
+      return
+    with self._state_lock:
+      previous = self._state.get(component) or {}
+      self._state[component] = _merge_state(copy.deepcopy(previous), message['event'])
+      # Only the evented properties whose own values changed, not everything
+      # that reads from the component (e.g. the streamer's clients, not its fps)
+      changed = [name for name in self.evented
+                 if self.fields[name][0] == component and _lookup(previous, self.fields[name][1:]) != _lookup(self._state[component], self.fields[name][1:])]
+      self._streaming = True
+    if changed and self.on_change is not None:
+      self.on_change(self, changed)
+
+  def _fetch(self, component):
     try:
-      res = requests.get(
-        url="http://localhost/api/atx",
+      response = self.session.get(
+        url="{}/{}".format(self.url, component),
         verify=False,
-        headers={
-          "X-KVMD-User":   self.config['pikvm_username'],
-          "X-KVMD-Passwd": self.config['pikvm_password']
-        }
-      ).json()
-      return "ON" if res['result']['leds']['power'] else "OFF"
+        timeout=10
+      )
+      return response.json()['result']
     except Exception as error:
+      return MeasurementError(str(error))
+
+  def acquire(self):
+    """Fetch the state of every component in use once, for all of the readings in this cycle."""
+    with self._state_lock:
+      streamed = set(self._state) if self._streaming else set()
+    self._polled = {component: self._fetch(component) for component in self._wanted - streamed}
+
+  def _get_state(self, component):
+    """The latest state of a kvmd component, from the event stream if it is connected."""
+    self._wanted.add(component)
+    with self._state_lock:
+      if self._streaming and component in self._state:
+        return copy.deepcopy(self._state[component])
+    state = self._polled.get(component)
+    if state is None:
+      state = self._polled[component] = self._fetch(component)
+    if isinstance(state, MeasurementError):
+      raise state
+    return state
+
+  def _field(self, component, *keys):
+    try:
+      value = self._get_state(component)
+      for key in keys:
+        value = value[key]
+      return value
+    except (KeyError, TypeError) as error:
       raise MeasurementError(str(error))
 
+  def _switch(self, component, *keys):
+    return "ON" if self._field(component, *keys) else "OFF"
+
+  @property
+  def atx_power(self):
+    """The state of power applied to the host."""
+    return self._switch(*self.fields['atx_power'])
+
+  @property
+  def atx_hdd_led(self):
+    """The state of the host's HDD activity LED."""
+    return self._switch(*self.fields['atx_hdd_led'])
+
+  @property
+  def streamer_fps(self):
+    """The frame rate captured from the host's video output."""
+    return self._field(*self.fields['streamer_fps'])
+
+  @property
+  def streamer_clients(self):
+    """The number of clients viewing the video stream."""
+    return self._field(*self.fields['streamer_clients'])
+
+  @property
+  def msd_connected(self):
+    """Whether the mass storage drive is connected to the host."""
+    return self._switch(*self.fields['msd_connected'])
+
+  @property
+  def hid_online(self):
+    """Whether the keyboard and mouse emulation is online."""
+    return self._switch(*self.fields['hid_online'])
+
   @property
   def serial_number(self):
     """The hardware identifier (serial number) for the device."""
-    cpuserial = "0000000000000000"
-    try:
-      f = open('/sys/firmware/devicetree/base/serial-number','r')
-      cpuserial = f.readline().rstrip('\x00')
-      f.close()
-    except:
-      cpuserial = "ERROR000000000"
-    return cpuserial
-
+    return rpi.serial_number()
@@ -0,0 +1,48 @@
+"""Identity of the Raspberry Pi hardware, which is only read once per process."""
+from functools import cache
+
+
+@cache
+def serial_number():
+  cpuserial = "0000000000000000"
+  try:
+    f = open('/sys/firmware/devicetree/base/serial-number','r')
+    cpuserial = f.readline().rstrip('\x00')
+    f.close()
+  except:
+    cpuserial = "ERROR000000000"
+  return cpuserial
+
+@cache
+def model():
+  model = "Unknown model"
+  try:
+    f = open('/sys/firmware/devicetree/base/model','r')
+    model = f.readline().rstrip('\x00')
+    f.close()
+  except:
+    model = "Error (unknown model)"
+  return model
+
+@cache
+def cpuinfo():
+  """The 'key: value' lines of /proc/cpuinfo, parsed once for all callers."""
+  info = {}
+  f = open('/proc/cpuinfo','r')
+  for line in f:
+    key, _, value = line.partition(':')
+    info[key.strip()] = value.strip()
+  f.close()
+  return info
+
+def hardware():
+  try:
+    return cpuinfo().get('Hardware', "Unknown")
+  except:
+    return "Error (unknown hardware)"
+
+def hardware_revision():
+  try:
+    return cpuinfo().get('Revision', "000000")
+  except:
+    return "ERROR000000"
@@ -1,9 +1,10 @@
-import os, time, psutil
+import os, time, glob, threading
 from typing import Optional
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import pacman
 from .measurementerror import MeasurementError
+from . import rpi
 
 class sysinfo():
 
@@ -11,9 +12,18 @@ class sysinfo():
   model = 'BCMxxxx'
   timezone = 'Europe/London'
 
-  update_check_timestamp = datetime.fromisoformat("2023-01-01T00:00")
+  thermal_zones = '/sys/class/thermal/thermal_zone*'
+  throttled_file = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+  # tmpfs usage is reported for the fullest of these
+  tmpfs_mounts = ('/tmp', '/run', '/var/log')
+  # Bits of the firmware's throttled flags: under-voltage, and the ways the
+  # CPU is held back (frequency capped, throttled, soft temperature limit)
+  under_voltage_flags = 0x1
+  throttled_flags = 0xE
+  under_voltage_occurred_flags = 0x10000
+
   update_check_interval_hours = 12
-  update_check_value = "OFF"
+  update_check_retry_minutes = 15
   pikvm_arch_packages = [
       'kvmd',
       'kvmd-fan',
@@ -39,90 +49,254 @@ class sysinfo():
 
   def __init__(self, addr: Optional[str] = None, config: Optional[dict] = None):
     self.model = "{bcm_model} ({rpi_model})".format(bcm_model=self.bcm_model, rpi_model=self.rpi_model)
+    options = config or {}
+    # Network throughput is summed over these interfaces (every one but the
+    # loopback, by default), and disk I/O is for this disk
+    self.interfaces = options.get('interfaces')
+    self.disk = options.get('disk', 'mmcblk0')
+    self.cpu_count = os.cpu_count()
+    self.thermal_zone = self._find_thermal_zone()
+    self._boot_time = None
+    self._snapshot = None
+    self._previous = None
+    self._update_checker = None
+    self._update_check_value = None
+    self._update_check_error = None
+    # Set by close(), to stop the background update check
+    self._closed = threading.Event()
+    # A first snapshot, so there is something to measure rates against from the first cycle
+    self.acquire()
+
+  def _find_thermal_zone(self):
+    for zone in sorted(glob.glob(self.thermal_zones)):
+      try:
+        with open(os.path.join(zone, 'type'), 'r') as f:
+          if f.read().strip() == 'cpu-thermal':
+            return os.path.join(zone, 'temp')
+      except IOError:
+        pass
+    return None
+
+  @staticmethod
+  def _read(path):
+    try:
+      with open(path, 'r') as f:
+        return f.read()
+    except IOError:
+      return None
+
+  def acquire(self):
+    """Take one snapshot of /proc and /sys, from which every property is served."""
+    snapshot = { 'time': time.monotonic() }
+    # Each source is read whole, once; anything that can't be read is left
+    # as None, and only the properties that depend on it fail
+    stat = self._read('/proc/stat')
+    if stat is not None:
+      for line in stat.splitlines():
+        fields = line.split()
+        if fields[0] == 'cpu':
+          # Idle time includes iowait
+          times = [int(value) for value in fields[1:]]
+          snapshot['cpu'] = (sum(times[:8]), times[3] + times[4])
+        elif fields[0] == 'btime':
+          snapshot['btime'] = int(fields[1])
+    for key, path in (('uptime', '/proc/uptime'), ('loadavg', '/proc/loadavg')):
+      text = self._read(path)
+      snapshot[key] = float(text.split()[0]) if text else None
+    meminfo = self._read('/proc/meminfo')
+    if meminfo is not None:
+      memory = { line.split(':')[0]: int(line.split()[1]) for line in meminfo.splitlines() if line.startswith(('MemTotal', 'MemAvailable')) }
+      snapshot['memory'] = (memory['MemTotal'], memory['MemAvailable'])
+    netdev = self._read('/proc/net/dev')
+    if netdev is not None:
+      received = sent = 0
+      for line in netdev.splitlines()[2:]:
+        interface, counters = line.split(':', 1)
+        interface = interface.strip()
+        if (self.interfaces is None and interface != 'lo') or (self.interfaces is not None and interface in self.interfaces):
+          counters = counters.split()
+          received += int(counters[0])
+          sent += int(counters[8])
+      snapshot['network'] = (received, sent)
+    diskstats = self._read('/proc/diskstats')
+    if diskstats is not None:
+      for line in diskstats.splitlines():
+        fields = line.split()
+        if fields[2] == self.disk:
+          # Sectors read and written, always of 512 bytes here
+          snapshot['disk'] = (int(fields[5]) * 512, int(fields[9]) * 512)
+    if self.thermal_zone is not None:
+      temperature = self._read(self.thermal_zone)
+      snapshot['temperature'] = int(temperature) / 1000 if temperature else None
+    usage = []
+    for mount in self.tmpfs_mounts:
+      try:
+        fs = os.statvfs(mount)
+        usage.append((fs.f_blocks - fs.f_bfree) / fs.f_blocks * 100 if fs.f_blocks else 0)
+      except OSError:
+        pass
+    snapshot['tmpfs'] = max(usage) if usage else None
+    throttled = self._read(self.throttled_file)
+    snapshot['throttled'] = int(throttled, 16) if throttled else None
+    self._previous, self._snapshot = self._snapshot, snapshot
+
+  def _value(self, key):
+    if self._snapshot is None:
+      self.acquire()
+    value = self._snapshot.get(key)
+    if value is None:
+      raise MeasurementError("Unable to read {} information".format(key))
+    return value
+
+  def _rate(self, key):
+    # Per second between the last two snapshots, for each of the counters under key
+    current = self._value(key)
+    if self._previous is None or self._previous.get(key) is None:
+      raise MeasurementError("Waiting for a second reading of {} information".format(key))
+    elapsed = self._snapshot['time'] - self._previous['time']
+    if elapsed <= 0:
+      raise MeasurementError("Waiting for a second reading of {} information".format(key))
+    return [(now - then) / elapsed for now, then in zip(current, self._previous[key])]
 
   @property
   def cpu_temperature(self):
     """The system CPU temperature in °C."""
-    try:
-      return psutil.sensors_temperatures()['cpu_thermal'][0].current
-    except Exception as error:
-      raise MeasurementError(str(error))
-  
+    return self._value('temperature')
+
   @property
   def uptime(self):
     """The system uptime in seconds."""
-    try:
-      uptime = time.time() - psutil.boot_time()
-      return int(uptime)
-    except Exception as error:
-      raise MeasurementError(str(error))
-  
+    return int(self._value('uptime'))
+
   @property
   def boot_time(self):
     """Timestamp (ISO 8601) of when the system was booted."""
-    try:
-      t = psutil.boot_time()
-      return datetime.fromtimestamp(t, ZoneInfo(self.timezone)).isoformat()
-    except Exception as error:
-      raise MeasurementError(str(error))
-  
+    if self._boot_time is None:
+      self._boot_time = datetime.fromtimestamp(self._value('btime'), ZoneInfo(self.timezone)).isoformat()
+    return self._boot_time
+
   @property
   def loadavg_1min(self):
     """The average system load over the last minute, in %."""
-    try:
-      return psutil.getloadavg()[0] / psutil.cpu_count() * 100
-    except Exception as error:
-      raise MeasurementError(str(error))
+    return self._value('loadavg') / self.cpu_count * 100
+
+  @property
+  def cpu_usage(self):
+    """CPU utilisation since the last reading, in %."""
+    total, idle = self._rate('cpu')
+    return (1 - idle / total) * 100 if total > 0 else 0.0
+
+  @property
+  def memory_usage(self):
+    """Memory in use (not available to be allocated), in %."""
+    total, available = self._value('memory')
+    return (total - available) / total * 100
+
+  @property
+  def tmpfs_usage(self):
+    """Usage of the fullest tmpfs filesystem, in %."""
+    return self._value('tmpfs')
+
+  @property
+  def network_received(self):
+    """Network throughput received since the last reading, in kB/s."""
+    return self._rate('network')[0] / 1000
+
+  @property
+  def network_sent(self):
+    """Network throughput sent since the last reading, in kB/s."""
+    return self._rate('network')[1] / 1000
+
+  @property
+  def disk_read(self):
+    """Disk reads since the last reading, in kB/s."""
+    return self._rate('disk')[0] / 1000
+
+  @property
+  def disk_written(self):
+    """Disk writes since the last reading, in kB/s."""
+    return self._rate('disk')[1] / 1000
+
+  @property
+  def under_voltage(self):
+    """Whether the supply voltage is currently too low."""
+    return "ON" if self._value('throttled') & self.under_voltage_flags else "OFF"
+
+  @property
+  def under_voltage_occurred(self):
+    """Whether the supply voltage has been too low since boot."""
+    return "ON" if self._value('throttled') & self.under_voltage_occurred_flags else "OFF"
+
+  @property
+  def throttled(self):
+    """Whether the CPU is currently being throttled or frequency capped."""
+    return "ON" if self._value('throttled') & self.throttled_flags else "OFF"
 
   @property
   def update_available(self):
     """Whether any OS packages for PiKVM have updates available."""
+    # The check takes tens of seconds, so it runs on its own schedule in the
+    # background (started by the first read) and this returns its last result
+    if self._update_checker is None:
+      self._update_checker = threading.Thread(target=self._check_for_updates, name='sysinfo-updates', daemon=True)
+      self._update_checker.start()
+    if self._update_check_value is None:
+      raise MeasurementError(self._update_check_error or "Update check has not completed yet")
+    return self._update_check_value
+
+  def _check_for_updates(self):
+    while not self._closed.is_set():
+      try:
+        self._update_check_value = self._pikvm_updates_available()
+        self._update_check_error = None
+        self._closed.wait(self.update_check_interval_hours * 3600)
+      except Exception as error:
+        self._update_check_error = str(error)
+        self._closed.wait(self.update_check_retry_minutes * 60)
+
+  def close(self):
+    """Stop the background update check, once this instance is no longer used."""
+    self._closed.set()
+
+  def _pikvm_updates_available(self):
+    # The package database lives on the root filesystem, which PiKVM keeps
+    # read-only; it is only made writable for the duration of the sync, and
+    # left alone if something else has already made it writable
+    remount = self._root_is_readonly()
+    if remount:
+      os.system('rw')
     try:
-      hours_since_last_check = divmod((datetime.now() - self.update_check_timestamp).total_seconds(), 3600)[0]
-      if hours_since_last_check > self.update_check_interval_hours:
-        os.system('rw')
-        pacman.refresh()
-        packages = pacman.get_installed()
-        upgradable = list(filter(lambda p: p['id'] in self.pikvm_arch_packages and p['upgradable'] is not False, packages))
-        self.update_check_value = "ON" if len(upgradable) > 0 else "OFF"
-        self.update_check_timestamp = datetime.now()
+      pacman.refresh()
+    finally:
+      if remount:
         os.system('ro')
-      return self.update_check_value
-    except Exception as error:
-      raise MeasurementError(str(error))
+    # 'pacman -Qu' lists just the upgradable packages (exiting with 1 and
+    # no error when there are none), rather than every installed package
+    result = pacman.pacman("-Qu")
+    if result['code'] != 0 and result['stderr']:
+      raise Exception("Failed to get upgradable list: {0}".format(result['stderr']))
+    upgradable = {line.split(' ', 1)[0] for line in result['stdout'].splitlines() if line.strip()}
+    return "ON" if upgradable.intersection(self.pikvm_arch_packages) else "OFF"
+
+  @staticmethod
+  def _root_is_readonly():
+    root_options = []
+    with open('/proc/mounts', 'r') as f:
+      for line in f:
+        fields = line.split()
+        if fields[1] == '/':
+          root_options = fields[3].split(',')
+    return 'ro' in root_options
 
   @property
   def serial_number(self):
     """The hardware identifier (serial number) for the device."""
-    cpuserial = "0000000000000000"
-    try:
-      f = open('/sys/firmware/devicetree/base/serial-number','r')
-      cpuserial = f.readline().rstrip('\x00')
-      f.close()
-    except:
-      cpuserial = "ERROR000000000"
-    return cpuserial
-  
+    return rpi.serial_number()
+
   @property
   def rpi_model(self):
-    model = "Unknown model"
-    try:
-      f = open('/sys/firmware/devicetree/base/model','r')
-      model = f.readline().rstrip('\x00')
-      f.close()
-    except:
-      model = "Error (unknown model)"
-    return model
+    return rpi.model()
 
   @property
   def bcm_model(self):
-    hw = "Unknown"
-    try:
-      f = open('/proc/cpuinfo','r')
-      for line in f:
-        if line[0:8]=='Hardware':
-          hw = line[10:26].strip()
-      f.close()
-    except:
-      hw = "Error (unknown hardware)"
-    return hw
+    return rpi.hardware()